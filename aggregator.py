@@ -0,0 +1,265 @@
+"""
+Combined view of several wipe stations
+Each turbofresa started with --aggregator pushes the state of its run (the same one shown by
+turbofresa status) every few seconds. The aggregator keeps it in memory, along with rolling
+statistics over the last hour, and serves them to anyone asking:
+    GET /           human readable summary
+    GET /summary    the same, as JSON
+    POST /stations/<name>    used by the agents
+Start it with "turbofresa aggregate", it needs nothing else than the standard library.
+"""
+
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque
+
+import run_status
+from json_server import JsonServer, Text
+
+PORT = 8470
+PUSH_INTERVAL = 5  # seconds between updates sent by a station
+STALE_AFTER = 60  # seconds without updates before a station is considered offline
+WINDOW = 3600  # seconds of history for the rolling statistics
+
+BUSY_STATES = ['parsing', 'registering', 'waiting', 'wiping', 'paused']
+FAILED_STATES = ['failed', 'crashed', 'error']
+FINAL_STATES = ['done', 'skipped'] + FAILED_STATES
+
+
+def processed_bytes(disk: dict) -> int:
+    """
+    :return: bytes written and read back so far, badblocks does a full write and a full read pass
+    """
+    capacity = disk.get('capacity') or 0
+    if disk.get('state') == 'done':
+        return 2 * capacity
+    if 'percentage' not in disk:
+        return 0
+    return int(capacity * (disk.get('badblocks_pass', 0) + disk['percentage'] / 100))
+
+
+class Aggregator(JsonServer):
+    def __init__(self, window: int = WINDOW, stale_after: int = STALE_AFTER):
+        """
+        :param window: seconds of history for the rolling statistics
+        :param stale_after: seconds without updates before a station is considered offline
+        """
+        super().__init__()
+        self.window = window
+        self.stale_after = stale_after
+        self.stations = {}  # name -> {'bays', 'received', 'run'}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self._disks = {}  # (station, run start, mount point) -> (state, processed bytes, time) of the last update
+        self._processed = deque()  # (timestamp, station, bytes processed since the previous update)
+        self._outcomes = deque()  # (timestamp, station, failed)
+        self._failures = 0
+        self._finished = 0
+
+    def receive(self, station: str, update: dict, now: float = None):
+        """
+        Records the state pushed by a station
+        :param update: {'bays': number of bays or None, 'run': state of run_status.RunStatus}
+        """
+        now = time.time() if now is None else now
+        run = update['run']
+        with self.lock:
+            previous = self.stations.get(station)
+            if previous is not None and previous['run']['started'] != run['started']:
+                # A new run, the disks of the old one won't change anymore
+                for key in [k for k in self._disks if k[0] == station and k[1] == previous['run']['started']]:
+                    del self._disks[key]
+            for mount_point, disk in run['disks'].items():
+                key = (station, run['started'], mount_point)
+                state = disk.get('state')
+                processed = processed_bytes(disk)
+                if key in self._disks:
+                    last_state, last_bytes, _ = self._disks[key]
+                else:
+                    # If the run started before the aggregator (e.g. it was restarted), what the disk did
+                    # so far isn't news. Neither are the bytes of a disk that's already finished.
+                    earlier = run['started'] < self.started
+                    last_state = state if earlier else None
+                    last_bytes = processed if earlier or state in FINAL_STATES else 0
+                if processed > last_bytes:
+                    self._processed.append((now, station, processed - last_bytes))
+                if state in FINAL_STATES and state != last_state and state != 'skipped':
+                    failed = state in FAILED_STATES
+                    self._outcomes.append((now, station, failed))
+                    self._finished += 1
+                    self._failures += int(failed)
+                self._disks[key] = (state, max(processed, last_bytes), now)
+            self.stations[station] = {'bays': update.get('bays'), 'received': now, 'run': run}
+            self._expire(now)
+
+    def _expire(self, now: float):
+        for history in (self._processed, self._outcomes):
+            while history and history[0][0] < now - self.window:
+                history.popleft()
+        # Not reported for a whole window: the station is gone, or its run is long finished
+        for key in [k for k, (_, _, seen) in self._disks.items() if seen < now - self.window]:
+            del self._disks[key]
+
+    def summary(self, now: float = None) -> dict:
+        """
+        :return: state of every station and of the whole fleet, with the rolling statistics
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            self._expire(now)
+            # Right after starting there's less than a window of history
+            hours = max(min(self.window, now - self.started), 1) / 3600
+            stations = {}
+            for name, station in sorted(self.stations.items()):
+                disks = station['run']['disks'].values()
+                busy = sum(1 for d in disks if d.get('state') in BUSY_STATES)
+                bays = station['bays']
+                stations[name] = {
+                    'online': now - station['received'] < self.stale_after,
+                    'running': station['run']['finished'] is None,
+                    'received': station['received'],
+                    'bays': bays,
+                    'busy': busy,
+                    'free': None if bays is None else max(bays - busy, 0),
+                    'gb-per-hour': sum(b for _, s, b in self._processed if s == name) / 1000**3 / hours,
+                    'finished': sum(1 for _, s, _ in self._outcomes if s == name),
+                    'failures': sum(1 for _, s, failed in self._outcomes if s == name and failed),
+                    'disks': station['run']['disks'],
+                }
+            return {
+                'window-seconds': self.window,
+                'stations': stations,
+                'busy': sum(s['busy'] for s in stations.values()),
+                'free': sum(s['free'] or 0 for s in stations.values() if s['online']),
+                'gb-per-hour': sum(b for _, _, b in self._processed) / 1000**3 / hours,
+                'finished': len(self._outcomes),
+                'failures': sum(1 for _, _, failed in self._outcomes if failed),
+                'finished-total': self._finished,
+                'failures-total': self._failures,
+            }
+
+    def respond(self, method: str, path: str, headers, body):
+        parts = [urllib.parse.unquote(p) for p in urllib.parse.urlsplit(path).path.split('/') if p]
+        if method == 'POST' and len(parts) == 2 and parts[0] == 'stations':
+            if not valid_update(body):
+                return 400, {'message': 'Expected {"bays": ..., "run": {"started": ..., "finished": ..., "disks": {...}}}'}
+            self.receive(parts[1], body)
+            return 204, None
+        if method == 'GET' and parts == ['summary']:
+            return 200, self.summary()
+        if method == 'GET' and parts == []:
+            return 200, Text(format_summary(self.summary()))
+        return 404, None
+
+
+def valid_update(body) -> bool:
+    """
+    :return: True if body looks like an update sent by an Agent
+    """
+    if not isinstance(body, dict) or not isinstance(body.get('run'), dict):
+        return False
+    if body.get('bays') is not None and not isinstance(body['bays'], int):
+        return False
+    run = body['run']
+    if not isinstance(run.get('started'), (int, float)) or not isinstance(run.get('disks'), dict):
+        return False
+    if 'finished' not in run:
+        return False
+    return all(isinstance(disk, dict) for disk in run['disks'].values())
+
+
+def format_summary(summary: dict) -> str:
+    """
+    Human readable view of Aggregator.summary
+    """
+    hours = summary['window-seconds'] / 3600
+    lines = [f"{len(summary['stations'])} stations, {summary['busy']} disks in progress, {summary['free']} free bays, "
+             f"{summary['gb-per-hour']:.0f} GB/h, {summary['failures']} failed of {summary['finished']} "
+             f"in the last {hours:.0f} h ({summary['failures-total']} of {summary['finished-total']} overall)"]
+    for name, station in summary['stations'].items():
+        if not station['online']:
+            state = 'OFFLINE'
+        elif station['running']:
+            state = 'running'
+        else:
+            state = 'idle'
+        bays = f"{station['busy']}/{station['bays']} bays busy" if station['bays'] is not None \
+            else f"{station['busy']} disks in progress"
+        lines.append(f"\n{name}: {state}, {bays}, {station['gb-per-hour']:.0f} GB/h, "
+                     f"{station['failures']} failed of {station['finished']}")
+        for mount_point, disk in sorted(station['disks'].items()):
+            lines.append(f"  /dev/{mount_point:<8} {disk.get('sn', ''):<20} {run_status.describe(disk)}")
+    return '\n'.join(lines)
+
+
+class Agent(threading.Thread):
+    """
+    Pushes the state of the run to the aggregator in the background, every interval seconds
+    A missing or unreachable aggregator never stops the wipe, it's only reported.
+    """
+    def __init__(self, url: str, run: run_status.RunStatus, station: str = None, bays: int = None, interval: float = PUSH_INTERVAL):
+        """
+        :param url: base url of the aggregator
+        :param run: run_status.RunStatus of this run
+        :param station: name of this station, defaults to the hostname
+        :param bays: number of disk bays of this station, None if unknown
+        """
+        super().__init__(daemon=True)
+        self.url = url.rstrip('/') + '/stations/' + urllib.parse.quote(station or socket.gethostname(), safe='')
+        self.run_status = run
+        self.bays = bays
+        self.interval = interval
+        self.failures = 0
+        self._stopped = threading.Event()
+
+    def push(self) -> bool:
+        """
+        :return: True if the aggregator received the update
+        """
+        body = json.dumps({'bays': self.bays, 'run': self.run_status.snapshot()}).encode()
+        request = urllib.request.Request(self.url, data=body, method='POST',
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.interval):
+                pass
+        except (urllib.error.URLError, OSError) as e:
+            if self.failures == 0:
+                print(f"Can't reach the aggregator at {self.url}: {e}")
+            self.failures += 1
+            return False
+        if self.failures > 0:
+            print(f"Aggregator reachable again after {self.failures} failed updates")
+            self.failures = 0
+        return True
+
+    def run(self):
+        self.push()
+        while not self._stopped.wait(self.interval):
+            self.push()
+
+    def stop(self):
+        """
+        Sends the last update and stops
+        """
+        self._stopped.set()
+        self.join()
+        self.push()
+
+
+def serve(host: str = '', port: int = PORT):
+    """
+    Runs the aggregator until interrupted
+    """
+    aggregator = Aggregator()
+    aggregator.start(host, port)
+    print(f"Aggregating stations on {aggregator.url}, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        aggregator.stop()
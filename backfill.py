@@ -0,0 +1,146 @@
+"""
+Re-ingests the archived smartctl outputs (smartctl/<serial>.txt) into T.A.R.A.L.L.O.
+Useful after fixing the parser: the files are parsed again in parallel and only the features
+that changed are pushed, in batches. Features changed by wiping (working, notes, ...) are left
+alone, since an archived output is older than the wipe.
+turbofresa imports this module on every start, so the heavy imports are done in the functions.
+"""
+
+import os
+
+import smartctl_parser
+
+BATCH_SIZE = 50
+
+
+def parse_file(path: str):
+    """
+    :return: features of the disk in a TARALLO friendly format, None if the file isn't a valid disk
+    """
+    try:
+        with open(path, 'r') as f:
+            disk = smartctl_parser.read_smartctl(f)
+    except IndexError:
+        # Not a smartctl -x output
+        return None
+    except Exception as e:
+        # Values the parser doesn't understand, a corrupted file...: one file mustn't stop the others
+        print(f"Can't parse {path}: {e}")
+        return None
+    if not smartctl_parser.check_complete(disk):
+        return None
+    return smartctl_parser.tarallo_conversion([disk])[0]['features']
+
+
+def parse_archive(directory: str, workers: int = None) -> list:
+    """
+    Parses every archived output in a directory, using all cores
+    :param workers: number of processes, defaults to the number of cores
+    :return: list of (path, features), features is None for invalid files
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.endswith('.txt') and not name.startswith('smartctl-dev-'))
+    with ProcessPoolExecutor(workers) as pool:
+        return list(zip(paths, pool.map(parse_file, paths, chunksize=32)))
+
+
+def diff(local: dict, remote: dict) -> dict:
+    """
+    :return: the features to upload, the ones that differ between the archive and T.A.R.A.L.L.O.
+    """
+    from tarallo_interface import VOLATILE_FEATURES
+    return {k: v for k, v in local.items() if k not in VOLATILE_FEATURES and remote.get(k) != v}
+
+
+def find_disk(tarallo, features: dict):
+    """
+    Looks a disk up by serial number, then by WWN in case the parser fix changed the serial number
+    :param tarallo: TaralloInterface instance
+    :return: list of codes
+    """
+    codes = tarallo.get_codes('sn', features['sn'])
+    if len(codes) == 0 and 'wwn' in features:
+        codes = tarallo.get_codes('wwn', features['wwn'])
+    return codes
+
+
+def fetch(tarallo, features: dict):
+    """
+    :return: (codes, features of the disk in T.A.R.A.L.L.O. if there's exactly one code, else None)
+    """
+    codes = find_disk(tarallo, features)
+    if len(codes) != 1:
+        return codes, None
+    return codes, tarallo.get_features(codes[0])
+
+
+def backfill(tarallo, parsed: list, dry_run: bool = False, batch_size: int = BATCH_SIZE,
+             interactive: bool = True) -> dict:
+    """
+    Compares the parsed disks with T.A.R.A.L.L.O. and uploads the differences
+    Disks in a batch are looked up and updated concurrently, up to tarallo.max_concurrency at once
+    :param tarallo: TaralloInterface instance
+    :param parsed: output of parse_archive
+    :param dry_run: only print what would be changed
+    :return: number of files for each outcome
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    counts = {'invalid': 0, 'missing': 0, 'conflict': 0, 'unchanged': 0, 'changed': 0}
+    valid = []
+    for path, features in parsed:
+        if features is None:
+            counts['invalid'] += 1
+        else:
+            valid.append((path, features))
+
+    pool = ThreadPoolExecutor(tarallo.max_concurrency)
+    for batch_start in range(0, len(valid), batch_size):
+        batch = valid[batch_start:batch_start + batch_size]
+        updates = []
+        fetched = pool.map(lambda item: fetch(tarallo, item[1]), batch)
+        for (path, features), (codes, remote) in zip(batch, fetched):
+            if len(codes) == 0:
+                counts['missing'] += 1
+                continue
+            if len(codes) > 1:
+                if interactive:
+                    print(f"{os.path.basename(path)}: multiple disks in the database ({', '.join(codes)}), skipped")
+                counts['conflict'] += 1
+                continue
+
+            upload = diff(features, remote)
+            if len(upload) == 0:
+                counts['unchanged'] += 1
+                continue
+            counts['changed'] += 1
+
+            if interactive or dry_run:
+                print(f"{features['sn']} ({codes[0]}):")
+                for feature, value in upload.items():
+                    print(f"  {feature}: {remote.get(feature)!r} -> {value!r}")
+            updates.append((codes[0], upload))
+
+        if not dry_run:
+            # list() to wait for them and raise the first error, if any
+            list(pool.map(lambda update: tarallo.update_features(*update), updates))
+        if interactive:
+            print(f"===> {min(batch_start + batch_size, len(valid))}/{len(valid)} disks compared")
+
+    pool.shutdown()
+    return counts
+
+
+def main(args, tarallo):
+    """
+    Entry point of turbofresa backfill
+    :param args: parsed command line arguments
+    :param tarallo: TaralloInterface instance
+    """
+    parsed = parse_archive(args.directory, args.workers)
+    counts = backfill(tarallo, parsed, dry_run=args.dry_run, batch_size=args.batch_size, interactive=not args.quiet)
+    verb = "would be updated" if args.dry_run else "updated"
+    print(f"{len(parsed)} files: {counts['changed']} disks {verb}, {counts['unchanged']} unchanged, "
+          f"{counts['missing']} not in the database, {counts['conflict']} conflicts, {counts['invalid']} invalid")
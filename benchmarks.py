@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for turbofresa, they don't need any disk or T.A.R.A.L.L.O. instance
+Usage: ./benchmarks.py [benchmark...]
+"""
+
+import argparse
+import os
+import subprocess as sp
+import sys
+import time
+
+STARTUP_BUDGET = 0.1  # seconds on top of the bare interpreter for turbofresa --version and status
+# Imported only when actually used, not to pay for them on every start
+LAZY_MODULES = ['pytarallo', 'requests', 'dotenv', 'numpy', 'concurrent.futures', 'aggregator']
+
+
+def tarallo_registration(disks: int = 50, latency: float = 0.005):
+    """
+    Registers disks through TaralloInterface on a FakeTarallo, one at a time and then all at once
+    :param disks: number of disks to register
+    :param latency: seconds added by the fake server to each request
+    """
+    import contextlib
+    import io
+    from fake_tarallo import FakeTarallo
+    from tarallo_interface import TaralloInterface
+
+    print(f"Registering {disks} disks with {latency * 1000:.1f} ms of latency per request")
+    for mode in ('sequential', 'concurrent'):
+        with FakeTarallo(latency=latency) as fake:
+            tarallo = TaralloInterface()
+            batch = [{
+                'brand': 'BENCHMARK',
+                'capacity-decibyte': 500000000000,
+                'model': 'TEST',
+                'smart-data': 'ok',
+                'sn': f'BENCH{i:06d}',
+                'type': 'hdd',
+                'working': 'yes',
+            } for i in range(disks)]
+            with contextlib.redirect_stdout(io.StringIO()):
+                tarallo.connect(fake.url, fake.token)
+                fake.reset_counters()
+
+                start = time.perf_counter()
+                if mode == 'sequential':
+                    for disk in batch:
+                        tarallo.add_disk(disk)
+                else:
+                    tarallo.add_disks(batch)
+                elapsed = time.perf_counter() - start
+
+        requests = sum(fake.requests.values())
+        print(f"  {mode}:")
+        print(f"    total time:     {elapsed:.3f} s ({elapsed / disks * 1000:.1f} ms per disk)")
+        print(f"    requests:       {requests} ({requests / disks:.1f} per disk)")
+        print("    by method:      " + ', '.join(f'{m} {n}' for m, n in sorted(fake.requests.items())))
+        print('    ' + tarallo.stats_summary().replace('\n', '\n    '))
+
+
+def fleet_history(disks: int = 10000, shards: int = 100):
+    """
+    Loads and aggregates a fleet history spread over many shards
+    :param disks: number of disks in the history
+    :param shards: number of runs they were recorded in
+    """
+    import random
+    import tempfile
+    import fleet
+
+    if fleet._numpy() is None:
+        print("NumPy is not installed, skipped")
+        return
+    models = [f'MODEL{i:03d}' for i in range(200)]
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        per_shard = -(-disks // shards)
+        for start in range(0, disks, per_shard):
+            rows = [fleet.make_row({'sn': f'SN{i:08d}', 'model': rng.choice(models), 'working': 'yes'},
+                                   {'throughput': rng.uniform(50, 200)},
+                                   {a: rng.randrange(1000) for a in (1, 5, 9, 12, 194, 197, 198)},
+                                   success=rng.random() > 0.05)
+                    for i in range(start, min(start + per_shard, disks))]
+            fleet.write_shard(rows, directory)
+
+        print(f"{disks} disks, {len(models)} models")
+        for label in ('sharded', 'compacted'):
+            start = time.perf_counter()
+            rates = fleet.failure_rates(fleet.load(directory, ['model', 'success', 'working']))
+            middle = time.perf_counter()
+            reallocated = int((fleet.attribute(fleet.load(directory, ['attributes']), 5) > 0).sum())
+            end = time.perf_counter()
+            print(f"  {label} ({len(fleet.shards(directory))} shards):")
+            print(f"    failure rate by model:      {(middle - start) * 1000:.1f} ms (worst {rates[0][0]})")
+            print(f"    disks with attribute 5 > 0: {(end - middle) * 1000:.1f} ms ({reallocated})")
+            fleet.compact(directory)
+
+
+def startup_time(args: list, runs: int = 5) -> float:
+    """
+    :param args: arguments for the interpreter
+    :return: best wall time of a few runs, in seconds
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        sp.run([sys.executable] + args, cwd=directory, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def startup_overhead(runs: int = 5) -> dict:
+    """
+    :return: seconds spent by turbofresa --version and status on top of starting the interpreter
+    """
+    bare = startup_time(['-c', 'pass'], runs)
+    return {command: startup_time(['turbofresa.py', command], runs) - bare for command in ('--version', 'status')}
+
+
+def startup(runs: int = 5):
+    """
+    Time to start turbofresa for commands that don't touch the disks, and the slowest imports
+    """
+    for command, overhead in startup_overhead(runs).items():
+        print(f"turbofresa {command}: {overhead * 1000:.1f} ms on top of the interpreter "
+              f"(budget {STARTUP_BUDGET * 1000:.0f} ms)")
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    output = sp.run([sys.executable, '-X', 'importtime', '-c', 'import turbofresa'], cwd=directory,
+                    stdout=sp.DEVNULL, stderr=sp.PIPE).stderr.decode()
+    # "import time: self [us] | cumulative | imported package", nested imports are indented
+    # Everything before site is imported by the interpreter itself
+    lines = output.splitlines()
+    sites = [i for i, line in enumerate(lines) if line.endswith('| site')]
+    imports = []
+    for line in lines[sites[-1] + 1 if sites else 0:]:
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit() and fields[2].startswith('   ') \
+                and not fields[2].startswith('    '):
+            imports.append((int(fields[1]), fields[2].strip()))
+    print("Modules imported by turbofresa (cumulative):")
+    for cumulative, name in sorted(imports, reverse=True)[:10]:
+        print(f"  {cumulative / 1000:6.1f} ms {name}")
+
+
+SMARTCTL_HEADER = """smartctl 7.1 2019-12-30 r5022 [x86_64-linux-5.4.0] (local build)
+
+=== START OF INFORMATION SECTION ===
+Model Family:     Seagate Barracuda 7200.14 (AF)
+Device Model:     ST500DM002-1BD142
+Serial Number:    Z3T0ABCD
+User Capacity:    500,107,862,016 bytes [500 GB]
+Rotation Rate:    7200 rpm
+Form Factor:      3.5 inches
+SATA Version is:  SATA 3.0, 6.0 Gb/s (current: 6.0 Gb/s)
+
+=== START OF READ SMART DATA SECTION ===
+SMART overall-health self-assessment test result: PASSED
+
+Vendor Specific SMART Attributes with Thresholds:
+ID# ATTRIBUTE_NAME          FLAGS    VALUE WORST THRESH FAIL RAW_VALUE
+  5 Reallocated_Sector_Ct   PO--CK   100   100   036    -    0
+
+SMART Extended Comprehensive Error Log Version: 1 (5 sectors)
+"""
+
+
+def peak_memory(function, *args) -> int:
+    """
+    :return: peak memory allocated while running function, in bytes
+    """
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def streaming(sizes: tuple = (10**4, 10**5, 10**6)):
+    """
+    Peak memory of parsing smartctl outputs and badblocks logs of growing size: it must not grow
+    A dying disk fills the smartctl error log and the badblocks output with lines.
+    """
+    import tempfile
+    import smartctl_parser
+    import surface_scan
+
+    def parse_whole(path):
+        with open(path) as f:
+            smartctl_parser.read_smartctl(f.read())
+
+    def parse_streaming(path):
+        with open(path) as f:
+            smartctl_parser.read_smartctl(f)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'lines':>9} {'file':>9} {'smartctl, read()':>16} {'smartctl, lines':>16} {'bad blocks':>11}")
+        for lines in sizes:
+            smartctl = os.path.join(directory, 'smartctl.txt')
+            with open(smartctl, 'w') as f:
+                f.write(SMARTCTL_HEADER)
+                for i in range(lines):
+                    f.write(f"Error {i} [{i % 5}] occurred at disk power-on lifetime: {i} hours\n")
+            badblocks = os.path.join(directory, 'badblocks.txt')
+            with open(badblocks, 'w') as f:
+                for i in range(lines):
+                    # Mostly contiguous, like a scratched platter
+                    f.write(f"{1000000 + i + i // 100 * 50}\n")
+
+            size = os.path.getsize(smartctl)
+            print(f"{lines:>9} {size / 1024**2:>7.1f}MB "
+                  f"{peak_memory(parse_whole, smartctl) / 1024:>14.0f}kB "
+                  f"{peak_memory(parse_streaming, smartctl) / 1024:>14.0f}kB "
+                  f"{peak_memory(surface_scan.bad_blocks_summary, badblocks) / 1024:>9.0f}kB")
+
+
+BENCHMARKS = {
+    'tarallo': tarallo_registration,
+    'fleet': fleet_history,
+    'startup': startup,
+    'streaming': streaming,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run turbofresa benchmarks.')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run, among ' + ', '.join(BENCHMARKS) + ' (default: all)')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"===> {name}")
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
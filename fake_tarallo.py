@@ -0,0 +1,147 @@
+"""
+In-process stand-in for the T.A.R.A.L.L.O. HTTP API
+Implements only the endpoints that pytarallo calls on behalf of turbofresa, so the Tarallo
+interface can be tested and benchmarked without a real instance.
+Latency and server errors can be injected, and items can be added directly to set up
+duplicate serial numbers.
+"""
+
+import random
+import threading
+import time
+import urllib.parse
+from collections import Counter
+
+from json_server import JsonServer
+
+TOKEN = 'fake-tarallo-token'
+LOCATIONS = ['Polito']
+
+
+class FakeTarallo(JsonServer):
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, token: str = TOKEN, seed=None):
+        """
+        :param latency: seconds to wait before answering each request
+        :param failure_rate: probability of answering any request with HTTP 500
+        :param token: the only token accepted
+        :param seed: seed for the failure injection
+        """
+        super().__init__()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.fail_next = 0  # the next N requests will fail with HTTP 500
+        self.token = token
+        self.items = {}
+        self.deleted = {}
+        self.requests = Counter()  # number of requests by HTTP method
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._next_code = 1
+
+    def add_item(self, features: dict, code: str = None, location: str = LOCATIONS[0]) -> str:
+        """
+        Adds an item directly, without going through HTTP (e.g. to create duplicates)
+        :return: code of the item
+        """
+        with self.lock:
+            if code is None:
+                code = self._new_code(features)
+            self.items[code] = {'code': code, 'features': dict(features), 'location': [location]}
+        return code
+
+    def codes_by_feature(self, feature: str, value) -> list:
+        with self.lock:
+            return [code for code, item in self.items.items() if item['features'].get(feature) == value]
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests.clear()
+
+    def _new_code(self, features: dict) -> str:
+        prefix = {'hdd': 'H', 'ssd': 'S'}.get(features.get('type'), 'I')
+        while prefix + str(self._next_code) in self.items:
+            self._next_code += 1
+        return prefix + str(self._next_code)
+
+    def _should_fail(self) -> bool:
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            return True
+        return self._random.random() < self.failure_rate
+
+    def respond(self, method: str, path: str, headers, body):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests[method] += 1
+            if headers.get('Authorization') != 'Token ' + self.token:
+                return 401, None
+            if self._should_fail():
+                return 500, {'message': 'Injected failure'}
+            return self.handle(method, path, body)
+
+    def handle(self, method: str, path: str, body):
+        """
+        Routes a request
+        :return: (HTTP status, JSON serializable response or None)
+        """
+        parts = [urllib.parse.unquote(p) for p in urllib.parse.urlsplit(path).path.strip('/').split('/')]
+        if parts[0] != 'v2':
+            return 404, None
+        parts = parts[1:]
+
+        if method == 'GET' and parts == ['session']:
+            return 200, None
+
+        if parts[:1] == ['features'] and len(parts) == 3 and method == 'GET':
+            # Tarallo compares features as strings in the url
+            codes = [code for code, item in self.items.items() if str(item['features'].get(parts[1])) == parts[2]]
+            return 200, codes
+
+        if parts[:1] == ['deleted'] and len(parts) == 2 and method == 'GET':
+            if parts[1] in self.deleted:
+                return 200, self.deleted[parts[1]]
+            return 404, None
+
+        if parts == ['items'] and method == 'POST':
+            return self._upload(self._new_code(body.get('features', {})), body)
+
+        if parts[:1] == ['items'] and len(parts) == 2:
+            code = parts[1]
+            if method == 'GET':
+                if code in self.items:
+                    return 200, dict(self.items[code], contents=[])
+                return 404, None
+            if method == 'PUT':
+                if code in self.items:
+                    return 400, {'message': f'Item {code} already exists'}
+                return self._upload(code, body)
+            if method == 'DELETE':
+                if code in self.items:
+                    self.deleted[code] = self.items.pop(code)
+                    return 204, None
+                return 404, None
+
+        if parts[:1] == ['items'] and parts[2:] == ['features'] and method == 'PATCH':
+            code = parts[1]
+            if code not in self.items:
+                return 404, {'item': code}
+            features = self.items[code]['features']
+            for feature, value in body.items():
+                # null deletes the feature
+                if value is None:
+                    features.pop(feature, None)
+                else:
+                    features[feature] = value
+            return 204, None
+
+        return 404, None
+
+    def _upload(self, code: str, body: dict):
+        if not body.get('features'):
+            return 400, {'message': 'No features'}
+        if body.get('parent') not in LOCATIONS:
+            return 404, {'item': body.get('parent')}
+        features = {k: v for k, v in body['features'].items() if v is not None}
+        self.items[code] = {'code': code, 'features': features, 'location': [body['parent']]}
+        return 201, code
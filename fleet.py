@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Columnar history of every disk processed, to find failure-prone models across the whole fleet
+Each run appends a shard (a NumPy .npz file) with the identity, wipe result, throughput and
+raw SMART attributes of its disks, one column per field and a disks x 256 matrix for the
+attributes. Loading every shard takes milliseconds, instead of parsing thousands of text files.
+NumPy is optional: without it nothing is recorded and a warning is printed.
+Usage: ./fleet.py [directory]
+"""
+
+import itertools
+import os
+import sys
+import time
+
+import smartctl_parser
+
+ATTRIBUTES = 256  # ATA attribute IDs are a byte
+MISSING = -1  # raw value of attributes not reported by a disk
+
+# name -> dtype, 'U' columns are strings
+COLUMNS = {
+    'sn': 'U',
+    'brand': 'U',
+    'model': 'U',
+    'family': 'U',
+    'type': 'U',
+    'capacity': 'i8',
+    'timestamp': 'f8',
+    'success': '?',
+    'working': 'U',
+    'elapsed-seconds': 'f4',
+    'throughput': 'f4',  # median MB/s of the surface scan
+    'slow-regions': 'i4',
+    'peak-temperature': 'f4',
+}
+
+COMPACT_AFTER = 20  # shards, see compact
+
+_shard_number = itertools.count()
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _shard_path(directory: str) -> str:
+    # Sorted by time, unique even for shards written by the same process in the same second
+    return os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_shard_number)}.npz")
+
+
+def fleet_dir() -> str:
+    return os.path.join(smartctl_parser.smartctl_dir(), 'fleet')
+
+
+def make_row(features: dict, status: dict, attributes: dict, success: bool, timestamp: float = None) -> dict:
+    """
+    :param features: features of the disk after the wipe
+    :param status: status record of the task
+    :param attributes: output of smartctl_parser.parse_attributes
+    :param success: whether the wipe succeeded
+    :return: a row for write_shard
+    """
+    return {
+        'sn': features.get('sn', ''),
+        'brand': features.get('brand', ''),
+        'model': features.get('model', ''),
+        'family': features.get('family', ''),
+        'type': features.get('type', ''),
+        'capacity': smartctl_parser.capacity(features) or 0,
+        'timestamp': time.time() if timestamp is None else timestamp,
+        'success': success,
+        'working': features.get('working', ''),
+        'elapsed-seconds': status.get('elapsed-seconds'),
+        'throughput': status.get('throughput'),
+        'slow-regions': status.get('slow-regions', 0),
+        'peak-temperature': status.get('peak-temperature'),
+        'attributes': attributes,
+    }
+
+
+def write_shard(rows: list, directory: str = None):
+    """
+    Writes rows as a new shard
+    :param directory: where shards are kept, defaults to fleet_dir()
+    :return: path of the shard, None if there was nothing to write or NumPy is missing
+    """
+    np = _numpy()
+    if np is None:
+        print("NumPy is not installed, the fleet history won't be updated")
+        return None
+    if len(rows) == 0:
+        return None
+    directory = directory or fleet_dir()
+    os.makedirs(directory, exist_ok=True)
+
+    columns = {}
+    for name, dtype in COLUMNS.items():
+        values = [row[name] for row in rows]
+        if dtype == 'U':
+            columns[name] = np.array(values, dtype=str)
+        elif dtype == 'f4':
+            columns[name] = np.array([np.nan if v is None else v for v in values], dtype=dtype)
+        else:
+            columns[name] = np.array(values, dtype=dtype)
+    attributes = np.full((len(rows), ATTRIBUTES), MISSING, dtype='i8')
+    for i, row in enumerate(rows):
+        for attribute, raw in row['attributes'].items():
+            attributes[i, attribute] = raw
+    columns['attributes'] = attributes
+
+    path = _shard_path(directory)
+    # Written under another name first, so that load never sees a half written shard
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def shards(directory: str = None) -> list:
+    directory = directory or fleet_dir()
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.npz'))
+
+
+def load(directory: str = None, columns: list = None) -> dict:
+    """
+    :param columns: columns to read, default all of them. Only the ones asked for are read from
+                    the disk, which makes a big difference when the attributes aren't needed
+    :return: columns of every shard, concatenated, as {name: array}; empty if there are no shards
+    """
+    np = _numpy()
+    if np is None:
+        raise RuntimeError("NumPy is needed to read the fleet history")
+    parts = []
+    for path in shards(directory):
+        with np.load(path) as shard:
+            parts.append({name: shard[name] for name in shard.files if columns is None or name in columns})
+    if len(parts) == 0:
+        return {}
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def compact(directory: str = None):
+    """
+    Merges every shard into a single one, to keep loading fast after many runs
+    :return: path of the merged shard, None if there was nothing to merge
+    """
+    np = _numpy()
+    old = shards(directory)
+    if np is None or len(old) < 2:
+        return None
+    data = load(directory)
+    path = _shard_path(directory or fleet_dir())
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **data)
+    os.replace(path + '.tmp', path)
+    for shard in old:
+        os.remove(shard)
+    return path
+
+
+def failure_rates(data: dict, by: str = 'model', min_disks: int = 1) -> list:
+    """
+    Groups the disks and counts how many of them failed the wipe or aren't fully working
+    :param data: output of load
+    :param by: column to group by
+    :param min_disks: skip groups with less disks than this
+    :return: list of (group, disks, failed, failure rate), worst first
+    """
+    np = _numpy()
+    if len(data) == 0:
+        return []
+    failed = ~data['success'] | (data['working'] != 'yes')
+    groups, inverse = np.unique(data[by], return_inverse=True)
+    totals = np.bincount(inverse, minlength=len(groups))
+    failures = np.bincount(inverse, weights=failed.astype(float), minlength=len(groups)).astype(int)
+    result = [(str(g), int(t), int(f), f / t) for g, t, f in zip(groups, totals, failures) if t >= min_disks]
+    return sorted(result, key=lambda r: (-r[3], -r[1], r[0]))
+
+
+def attribute(data: dict, attribute_id: int):
+    """
+    :return: raw values of an attribute for every disk, as a masked array (masked where not reported)
+    """
+    np = _numpy()
+    column = data['attributes'][:, attribute_id]
+    return np.ma.masked_equal(column, MISSING)
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else None
+    start = time.perf_counter()
+    data = load(directory, ['sn', 'model', 'success', 'working', 'attributes'])
+    if len(data) == 0:
+        print("No disks recorded yet")
+        return
+    elapsed = time.perf_counter() - start
+    print(f"{len(data['sn'])} disks ({len(set(data['sn']))} unique) loaded in {elapsed * 1000:.1f} ms")
+    print(f"{'model':<30} {'disks':>6} {'failed':>6} {'rate':>6}")
+    for model, disks, failed, rate in failure_rates(data)[:20]:
+        print(f"{model:<30} {disks:>6} {failed:>6} {rate:>6.1%}")
+    reallocated = attribute(data, 5)
+    if reallocated.count() > 0:
+        print(f"Reallocated sectors (5): {int((reallocated > 0).sum())} of {reallocated.count()} disks have some")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+JSON over HTTP, served from a background thread
+Shared by the aggregator and by FakeTarallo: subclasses of JsonServer only have to answer
+each request in respond.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Text(str):
+    """
+    A response sent as plain text instead of JSON
+    """
+
+
+class JsonServer:
+    def __init__(self):
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """
+        Starts serving, on a random local port by default
+        :return: the base url of the server
+        """
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def respond(self, method: str, path: str, headers, body):
+        """
+        Answers a request, called from the thread serving it
+        :param headers: headers of the request
+        :param body: decoded JSON body, None if there's none
+        :return: (HTTP status code, response), response is sent as JSON unless it's a Text
+        """
+        raise NotImplementedError
+
+
+def _handler(server: JsonServer):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, clients send many requests in a row
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are written separately, don't wait for delayed ACKs between them
+        disable_nagle_algorithm = True
+
+        def _serve(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                body = json.loads(self.rfile.read(length)) if length > 0 else None
+            except ValueError:
+                status, response = 400, {'message': 'Invalid JSON'}
+            else:
+                status, response = server.respond(self.command, self.path, self.headers, body)
+
+            if isinstance(response, Text):
+                payload, content_type = response.encode() + b'\n', 'text/plain; charset=utf-8'
+            else:
+                payload, content_type = b'' if response is None else json.dumps(response).encode(), 'application/json'
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _serve
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,100 @@
+"""
+Overwrites the metadata of a disk before the full wipe
+A full pass takes hours, and until it's done a disk pulled by mistake still has its partition
+table, filesystem superblocks and LVM/LUKS headers. Zeroing them first takes a few seconds and
+makes the data unreadable without specialized tools, then the full pass does the rest.
+"""
+
+import os
+import subprocess as sp
+
+KIB = 1024
+MIB = 1024**2
+GIB = 1024**3
+
+# Signatures that wipefs would find, as (offset, length): negative offsets are from the end.
+# They are applied to the whole disk and to every partition.
+SIGNATURES = [
+    # MBR, GPT header and table, LVM label, LUKS1/2 headers, md 1.1/1.2, XFS, NTFS, FAT, ext, swap,
+    # ISO9660, ReiserFS and ZFS labels 0-1 all live in the first MiB
+    (0, MIB),
+    # GPT backup, md 0.90/1.0, NTFS backup boot sector and ZFS labels 2-3
+    (-MIB, MIB),
+    # btrfs superblock mirrors
+    (64 * MIB, 4 * KIB),
+    (256 * GIB, 4 * KIB),
+]
+# ext2/3/4 backup superblocks (4 KiB blocks, sparse_super): at the start of groups 1, 3^n, 5^n and 7^n
+EXT_GROUP_SIZE = 128 * MIB
+EXT_BACKUP_GROUPS = [1, 3, 5, 7, 9, 25, 27, 49, 81, 125, 243, 343, 625, 729, 2187, 2401, 3125]
+SIGNATURES += [(group * EXT_GROUP_SIZE, 4 * KIB) for group in EXT_BACKUP_GROUPS]
+
+
+def device_size(mount_point: str) -> int:
+    """
+    :return: actual size of the disk in bytes (smartctl capacity is rounded)
+    """
+    with open(os.path.join('/sys/class/block', mount_point, 'size')) as f:
+        return int(f.read()) * 512
+
+
+def partitions(mount_point: str) -> list:
+    """
+    :return: list of (start, length) in bytes of the partitions on the disk
+    """
+    result = []
+    path = os.path.join('/sys/class/block', mount_point)
+    for name in sorted(os.listdir(path)):
+        if not name.startswith(mount_point):
+            continue
+        with open(os.path.join(path, name, 'start')) as f:
+            start = int(f.read()) * 512
+        with open(os.path.join(path, name, 'size')) as f:
+            length = int(f.read()) * 512
+        result.append((start, length))
+    return result
+
+
+def metadata_regions(size: int, parts: list = ()) -> list:
+    """
+    :param size: size of the disk in bytes
+    :param parts: partitions on the disk, as (start, length) in bytes
+    :return: sorted and merged list of (offset, length) to overwrite
+    """
+    regions = []
+    for area_start, area_length in [(0, size)] + list(parts):
+        for offset, length in SIGNATURES:
+            if offset < 0:
+                offset += area_length
+            # Signatures that don't fit (small disk or partition) are clipped or skipped
+            offset = max(offset, 0)
+            length = min(length, area_length - offset)
+            if length > 0:
+                regions.append((area_start + offset, length))
+
+    merged = []
+    for offset, length in sorted(regions):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            last_offset, last_length = merged[-1]
+            merged[-1] = (last_offset, max(last_length, offset + length - last_offset))
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+def destroy_metadata(mount_point: str) -> bool:
+    """
+    Zeroes every metadata region of a disk
+    :param mount_point: name of the disk (e.g. sda)
+    :return: True if every region has been overwritten
+    """
+    regions = metadata_regions(device_size(mount_point), partitions(mount_point))
+    success = True
+    for offset, length in regions:
+        return_code = sp.run(['sudo', '-n', 'dd', 'if=/dev/zero', 'of=' + os.path.join('/dev', mount_point),
+                              'bs=1M', 'seek=' + str(offset), 'count=' + str(length),
+                              'oflag=seek_bytes', 'iflag=count_bytes', 'conv=notrunc,fsync',
+                              'status=none']).returncode
+        if return_code != 0:
+            success = False
+    return success
@@ -0,0 +1,125 @@
+"""
+State of the current run, kept in a file so that "turbofresa status" can show it from another
+terminal (or a script) in a few milliseconds, without touching the disks or T.A.R.A.L.L.O.
+"""
+
+import json
+import os
+import threading
+import time
+
+STATUS_FILE = os.path.join('smartctl', 'status.json')  # relative to the working directory, like smartctl/
+
+
+class RunStatus:
+    """
+    Writes the state of every disk to the status file each time it changes
+    """
+    def __init__(self, path: str = STATUS_FILE):
+        self.path = path
+        self.state = {'pid': os.getpid(), 'started': time.time(), 'updated': None, 'finished': None, 'disks': {}}
+        self._lock = threading.Lock()
+        self.save()
+
+    def update(self, mount_point: str, **fields):
+        """
+        :param mount_point: name of the disk (e.g. sda)
+        :param fields: what changed, e.g. state='wiping', percentage=42
+        """
+        with self._lock:
+            self.state['disks'].setdefault(mount_point, {}).update(fields)
+            self._save()
+
+    def snapshot(self) -> dict:
+        """
+        :return: a copy of the state, safe to use while the run goes on
+        """
+        with self._lock:
+            return json.loads(json.dumps(self.state))
+
+    def finish(self):
+        with self._lock:
+            self.state['finished'] = time.time()
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self.state['updated'] = time.time()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Replaced in one go, a reader never sees half a file
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def read(path: str = STATUS_FILE):
+    """
+    :return: state of the last run, None if there's no status file
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def is_running(state: dict) -> bool:
+    if state['finished'] is not None:
+        return False
+    try:
+        os.kill(state['pid'], 0)
+    except ProcessLookupError:
+        # Killed or crashed before finishing
+        return False
+    except PermissionError:
+        # Started with sudo, but it's there
+        pass
+    return True
+
+
+def describe(disk: dict) -> str:
+    """
+    :return: a disk state in a few words, e.g. "reading and comparing 42%, metadata destroyed"
+    """
+    state = disk.get('state', '?')
+    if state == 'wiping' and 'percentage' in disk:
+        phase = 'writing' if disk.get('badblocks_pass', 0) == 0 else 'reading and comparing'
+        text = f"{phase} {disk['percentage']}%"
+    elif state == 'paused' and disk.get('temperature') is not None:
+        text = f"paused, {disk['temperature']} °C"
+    elif state in ('done', 'failed') and 'working' in disk:
+        text = f"{state}, working: {disk['working']}"
+    else:
+        text = state
+    # Only with --metadata-first
+    if 'metadata-destroyed' in disk:
+        text += ', metadata destroyed' if disk['metadata-destroyed'] else ', metadata NOT destroyed'
+    if disk.get('reported') is False:
+        text += ', NOT in T.A.R.A.L.L.O.'
+    return text
+
+
+def format_status(state: dict, now: float = None) -> str:
+    """
+    Human readable status of a run
+    """
+    now = time.time() if now is None else now
+    if is_running(state):
+        header = f"Running (pid {state['pid']}) for {(now - state['started']) / 60:.0f} min"
+    elif state['finished'] is not None:
+        header = f"Finished {(now - state['finished']) / 60:.0f} min ago, " \
+                 f"after {(state['finished'] - state['started']) / 60:.0f} min"
+    else:
+        header = f"Not running anymore (pid {state['pid']}), last update {(now - state['updated']) / 60:.0f} min ago"
+
+    lines = [header]
+    for mount_point, disk in sorted(state['disks'].items()):
+        lines.append(f"/dev/{mount_point:<8} {disk.get('sn', ''):<20} {describe(disk)}")
+    if len(state['disks']) == 0:
+        lines.append("No disks yet")
+    return '\n'.join(lines)
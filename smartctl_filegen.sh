@@ -1,20 +1,25 @@
 #!/bin/bash
+# Usage: sudo ./smartctl_filegen.sh [/optional/path/to/files [disk...]]
 if [ $# -eq 0 ]; then
     echo "No path given: outputting files to working directory"
     OUTPATH="."
-elif [ $# -eq 1 ]; then
+else
     echo "Outputting files to "$1
     OUTPATH="$(dirname $1)/$(basename $1)"
-else
-    echo -n "Unexpected number of parameters.\nUsage: sudo ./generate_files.sh /optional/path/to/files"
+    shift
 fi
 
 [ ! -d $OUTPATH ] && mkdir $OUTPATH
 
-# removing all old smartctl files before writing new ones
-rm -f "$OUTPATH"/*.txt
-
-DISKZ=($(lsblk -d -I 8 -o NAME -n))
+if [ $# -gt 0 ]; then
+    # several instances may be running at once, one per disk: leave the other files alone
+    DISKZ=("$@")
+else
+    # removing all old smartctl files before writing new ones
+    # (files already renamed to <serial>.txt are kept as an archive)
+    rm -f "$OUTPATH"/smartctl-dev-*.txt
+    DISKZ=($(lsblk -d -I 8 -o NAME -n))
+fi
 echo Found $((${#DISKZ[@]})) disks
 for d in "${DISKZ[@]}"; do
 	  smartctl -d sat,auto -T verypermissive -x /dev/$d > "$OUTPATH/smartctl-dev-$d.txt"
@@ -9,6 +9,10 @@ from enum import Enum
 
 import sys
 import os
+import json
+import shlex
+import threading
+import time
 import subprocess as sp
 from math import log10, floor
 
@@ -52,69 +56,237 @@ class PORT(Enum):
     # TODO: add more, if they can even be detected
 
 
-def parse_disks(interactive: bool = False, ignore: list = [], usbdebug: bool = False):
+CACHE_TTL = 3600  # seconds, can be changed with --cache-ttl
+
+
+def parse_disks(interactive: bool = False, ignore: list = [], usbdebug: bool = False, cache_ttl: int = CACHE_TTL):
     """
     Parses disks mounted on the current machine
     :param interactive: adds verbosity if set to True
     :param ignore: list of disks to ignore (eg. 'sda', 'sdb', etc.)
     :param usbdebug: allow scan of USB drives (FOR TEST PURPOSES, USE ONLY ON A TEST INSTANCE OF TARALLO!!!)
+    :param cache_ttl: reuse disks parsed less than this many seconds ago, only refreshing their SMART status
     :return: list of disks in a TARALLO friendly format
     """
 
     disks = []
+    cache = SmartCache(os.path.join(smartctl_dir(), "cache.json"), cache_ttl)
+
+    for device in filter_devices(list_devices(), ignore, interactive):
+        disk = parse_disk(device, cache, interactive, usbdebug)
+        if disk is not None:
+            disks.append(disk)
+
+    cache.save()
+
+    if len(disks) >= 1:
+        return tarallo_conversion(disks)
+    return []
+
+
+def smartctl_dir() -> str:
+    """
+    :return: path of the directory with the smartctl outputs, created if missing
+    """
     smartctl_path = os.path.join(os.getcwd(), "smartctl")
     if not os.path.exists(smartctl_path):
-        os.makedirs(smartctl_path)
+        os.makedirs(smartctl_path, exist_ok=True)
+    return smartctl_path
+
+
+def filter_devices(devices: list, ignore: list, interactive: bool = False) -> list:
+    """
+    Removes disks pointed on call from a list_devices list
+    """
+    result = []
+    for device in devices:
+        ignored = False
+        for mount_point in ignore:
+            if mount_point in device['name']:
+                ignored = True
+                break
+        if ignored is True:
+            if interactive is True:
+                print("Disk mounted at /dev/"+mount_point+" ignored")
+            continue
+        result.append(device)
+    return result
+
 
+def parse_disk(device: dict, cache, interactive: bool = False, usbdebug: bool = False):
+    """
+    Parses a single disk, skipping the full smartctl -x if it has been seen recently
+    :param device: a device from list_devices
+    :param cache: SmartCache to look the disk up and store it
+    :return: Disk, None if it's not a valid disk
+    """
+    keys = identity_keys(device)
+    disk = cache.get(keys)
+    if disk is not None:
+        disk.dev = device['name']
+        if refresh_disk(disk):
+            if interactive:
+                print(f"/dev/{device['name']} already parsed recently, refreshed its SMART status only")
+            cache.put(keys, disk, refreshed=True)
+            return disk
+        if interactive:
+            print(f"/dev/{device['name']} looks like a disk parsed recently but it's another one, parsing it again")
+
+    smartctl_path = smartctl_dir()
     filegen = os.path.join(os.getcwd(), "smartctl_filegen.sh")
-    return_code = sp.run(["sudo", "-S", filegen, smartctl_path]).returncode
+    return_code = sp.run(["sudo", "-S", filegen, smartctl_path, device['name']], stdout=sp.DEVNULL).returncode
     assert (return_code == 0), 'Error during disk detection'
 
-    files = os.listdir(smartctl_path)
-    for filename in files:
-        if "smartctl-dev-" in filename:
+    # File reading, line by line
+    filename = "smartctl-dev-" + device['name'] + ".txt"
+    try:
+        with open(os.path.join(smartctl_path, filename), 'r') as f:
+            disk = read_smartctl(f)
+    except FileNotFoundError:
+        raise InputFileNotFoundError(smartctl_path)
+
+    # Checks if it's a valid disk
+    # If usbdebug is True, the disk is filled with dummy informations
+    if not check_complete(disk):
+        if usbdebug is True:
+            disk = dummy_disk(disk)
+        else:
+            if interactive:
+                print(f"{filename} does not contain disk information, was it a USB stick?")
+            return None
 
-            # Ignoring disks pointed on call
-            ignored = False
-            for mount_point in ignore:
-                if mount_point in filename:
-                    ignored = True
-                    break
-            if ignored is True:
-                if interactive is True:
-                    print("Disk mounted at /dev/"+mount_point+" ignored")
-                os.remove(os.path.join(smartctl_path, filename))
+    disk.dev = device['name']
+
+    old_filename = os.path.join(smartctl_path, filename)
+    new_filename = os.path.join(smartctl_path, disk.serial_number) + ".txt"
+    os.rename(old_filename, new_filename)
+
+    cache.put(keys, disk)
+    return disk
+
+
+def list_devices() -> list:
+    """
+    Lists the disks that smartctl_filegen.sh would scan, with what identifies them without running smartctl
+    :return: list of dicts with name, serial, wwn and by-id path (empty if unknown)
+    """
+    output = sp.check_output(["lsblk", "-d", "-I", "8", "-n", "-P", "-o", "NAME,SERIAL,WWN"]).decode(sys.stdout.encoding)
+
+    by_id = {}
+    by_id_path = "/dev/disk/by-id"
+    if os.path.isdir(by_id_path):
+        # wwn-* links are already covered by the WWN, prefer the ata-*/usb-*/... ones
+        for link in sorted(os.listdir(by_id_path)):
+            if link.startswith("wwn-") or "-part" in link:
                 continue
+            target = os.path.basename(os.path.realpath(os.path.join(by_id_path, link)))
+            by_id.setdefault(target, os.path.join(by_id_path, link))
+
+    devices = []
+    for line in output.splitlines():
+        # NAME="sda" SERIAL="WD-WCC4N0123456" WWN="0x50014ee2b5e6f3a1"
+        fields = dict(pair.split("=", 1) for pair in shlex.split(line))
+        devices.append({
+            'name': fields.get('NAME', ''),
+            'serial': fields.get('SERIAL', ''),
+            'wwn': fields.get('WWN', ''),
+            'by-id': by_id.get(fields.get('NAME', ''), ''),
+        })
+    return devices
 
-            # File reading
+
+def identity_keys(device: dict) -> list:
+    """
+    :param device: a device from list_devices
+    :return: keys that identify the disk in the cache, regardless of where it's connected
+    """
+    return [key + ':' + device[key] for key in ['serial', 'wwn', 'by-id'] if device.get(key)]
+
+
+class SmartCache:
+    """
+    Parsed disks, keyed by serial number, WWN and by-id path
+    Saved as JSON next to the smartctl outputs, so it survives restarts
+    """
+    def __init__(self, path: str, ttl: int = CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = []
+        self.lock = threading.Lock()  # disks may be parsed in parallel
+        if ttl > 0 and os.path.exists(path):
             try:
-                with open(os.path.join(smartctl_path, filename), 'r') as f:
-                    output = f.read()
-            except FileNotFoundError:
-                raise InputFileNotFoundError(smartctl_path)
-
-            # Checks if it's a valid disk
-            # If usbdebug is True, the disk is filled with dummy informations
-            disk = read_smartctl(output)
-            if not check_complete(disk):
-                if usbdebug is True:
-                    disk = dummy_disk(disk)
-                else:
-                    if interactive:
-                        print(f"{filename} does not contain disk information, was it a USB stick?")
-                    continue
-
-            disk.dev = filename.split("smartctl-dev-")[1].split(".txt")[0]
-
-            old_filename = os.path.join("smartctl/", filename)
-            new_filename = os.path.join("smartctl/", disk.serial_number) + ".txt"
-            os.rename(old_filename, new_filename)
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                # Corrupted cache, it'll be rebuilt
+                self.entries = []
+
+    def get(self, keys: list):
+        """
+        :return: the cached Disk if any of the keys matches a fresh entry, None otherwise
+        """
+        if self.ttl <= 0 or len(keys) == 0:
+            return None
+        now = time.time()
+        with self.lock:
+            for entry in self.entries:
+                if now - entry['time'] < self.ttl and set(keys) & set(entry['keys']):
+                    return disk_from_dict(entry['disk'])
+        return None
+
+    def put(self, keys: list, disk: Disk, refreshed: bool = False):
+        """
+        :param refreshed: disk comes from get with only its SMART status refreshed, it expires
+                          when the full parse it comes from does
+        """
+        if len(keys) == 0:
+            return
+        with self.lock:
+            replaced = [e for e in self.entries if set(keys) & set(e['keys'])]
+            parsed = time.time()
+            if refreshed and replaced:
+                parsed = min(e['time'] for e in replaced)
+            self.entries = [e for e in self.entries if not set(keys) & set(e['keys'])]
+            self.entries.append({'time': parsed, 'keys': keys, 'disk': disk_to_dict(disk)})
+
+    def save(self):
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.entries = [e for e in self.entries if now - e['time'] < self.ttl]
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f)
+
+
+def disk_to_dict(disk: Disk) -> dict:
+    result = dict(vars(disk))
+    result['port'] = disk.port.value
+    result['smart_data'] = disk.smart_data.value
+    if disk.smart_data_long is SMART.not_available:
+        result['smart_data_long'] = None
+    return result
 
-            disks.append(disk)
 
-    if len(disks) >= 1:
-        return tarallo_conversion(disks)
-    return []
+def disk_from_dict(data: dict) -> Disk:
+    disk = Disk()
+    for key, value in data.items():
+        setattr(disk, key, value)
+    disk.port = PORT(data['port'])
+    disk.smart_data = SMART(data['smart_data'])
+    if data['smart_data_long'] is None:
+        disk.smart_data_long = SMART.not_available
+    return disk
+
+
+def refresh_disk(disk: Disk) -> bool:
+    """
+    Updates only the SMART status and attributes of a disk, which is way faster than smartctl -x
+    :return: False if the drive in disk.dev isn't this disk, see read_refresh
+    """
+    with sp.Popen(["sudo", "-S", "smartctl", "-d", "sat,auto", "-T", "verypermissive", "-i", "-H", "-A",
+                   os.path.join("/dev", disk.dev)], stdout=sp.PIPE, encoding=sys.stdout.encoding, errors='replace') as p:
+        return read_refresh(p.stdout, disk)
 
 
 def dummy_disk(disk=Disk()):
@@ -157,116 +329,54 @@ def check_complete(disk):
     return True
 
 
-def read_smartctl(smartctl_output):
-
-    disk = Disk()
+def iter_lines(smartctl_output):
+    """
+    Yields the lines of an output, one at a time and without the line terminator
+    :param smartctl_output: the whole output as a string, or an iterable of lines (e.g. an open file or a pipe)
+    """
+    if isinstance(smartctl_output, str):
+        # Not splitlines() or StringIO: both make a copy of the whole output at once
+        start = 0
+        while start < len(smartctl_output):
+            end = smartctl_output.find('\n', start)
+            if end == -1:
+                end = len(smartctl_output)
+            yield smartctl_output[start:end].rstrip('\r')
+            start = end + 1
+        return
+    for line in smartctl_output:
+        yield line.rstrip('\r\n')
 
-    data = smartctl_output.split('=== START OF INFORMATION SECTION ===', 1)[1] \
-        .split('=== START OF READ SMART DATA SECTION ===', 1)[0]
 
-    # For manual inspection later on
-    if 'Vendor Specific SMART Attributes with Thresholds:' in smartctl_output:
-        disk.smart_data_long = 'Vendor Specific SMART Attributes with Thresholds:' + \
-                               smartctl_output.split('Vendor Specific SMART Attributes with Thresholds:', 1)[1].split('\n\n', 1)[
-                                   0]
-    elif 'SMART/Health Information' in smartctl_output:
-        disk.smart_data_long = 'SMART/Health Information' + \
-                               smartctl_output.split('SMART/Health Information', 1)[1].split('\n\n', 1)[0]
+def read_smartctl(smartctl_output):
+    """
+    Reads the output of smartctl -x in a single pass, line by line
+    :param smartctl_output: the output as a string, or an iterable of lines (e.g. an open file)
+    :return: Disk
+    """
 
-    status = "not supported"
-    for line in smartctl_output.splitlines():
-        if "SMART overall-health" in line:
-            status = line.split(":")[1].strip()
-        elif "Device does not support Self Test logging" in line:
-            status = "not supported"
-
-    if status == "PASSED":
-        # the disk is working fine
-        disk.smart_data = SMART.working
-
-    elif status == "FAILED!":
-        # the disk is not working fine
-        disk.smart_data = SMART.fail
-
-    elif status == "UNKNOWN!":
-        # the connection timed out, there could be different reasons
-        disk.smart_data = SMART.not_available
-
-    # TODO: throw a catastrophic fatal error of death if a disk has SMART disabled (can be enabled and disabled with smartctl to test and view the exact error message)
-
-    elif status == "not supported":
-        # the smart data need to be switched on or the smart capability is not supported
-        for line in data.splitlines():
-            if "SMART support is:" in line:
-                line = line.split("SMART support is:")[1].strip()
-                if "device lacks SMART capability" in line:
-                    # disk doesn't support smart capabilities
-                    disk.smart_data = SMART.not_available
-                elif "device has SMART capability" in line:
-                    # you need to enable smart capabilities
-                    print("you need to enable smart capabilities on disk")
-                    disk.smart_data = SMART.not_available
-
-    for line in data.splitlines():
-        if "Model Family:" in line:
-            line = line.split("Model Family:")[1].strip()
-            brand, family = split_brand_and_other(line)
-            disk.family = family
-            if brand is not None:
-                disk.brand = brand
-
-        elif "Model Number:" in line:
-            line = line.split("Model Number:")[1].strip()
-            brand, model = split_brand_and_other(line)
-            disk.model = model
-            if brand is not None:
-                disk.brand = brand
-
-        elif "Device Model:" in line:
-            line = line.split("Device Model:")[1].strip()
-            brand, model = split_brand_and_other(line)
-            disk.model = model
-            if brand is not None:
-                disk.brand = brand
-
-        elif "Serial Number:" in line:
-            disk.serial_number = normalize_sn(line.split("Serial Number:")[1].strip())
-
-        elif "LU WWN Device Id:" in line:
-            disk.wwn = line.split("LU WWN Device Id:")[1].strip()
-
-        elif "Form Factor:" in line:
-            ff = line.split("Form Factor:")[1].strip()
-            # https://github.com/smartmontools/smartmontools/blob/40468930fd77d681b034941c94dc858fe2c1ef10/smartmontools/ataprint.cpp#L405
-            if ff == '3.5 inches':
-                disk.form_factor = '3.5'
-            elif ff == '2.5 inches':
-                # This is the most common height, just guessing...
-                disk.form_factor = '2.5-7mm'
-            elif ff == '1.8 inches':
-                # Still guessing...
-                disk.form_factor = '1.8-8mm'
-            elif ff == 'M.2':
-                disk.form_factor = 'm2'
-
-        elif "User Capacity:" in line:
-            # https://stackoverflow.com/a/3411435
-            num_bytes = line.split('User Capacity:')[1].split("bytes")[0].strip().replace(',', '').replace('.',
-                                                                                                           '')
-            round_digits = int(floor(log10(abs(float(num_bytes))))) - 2
-            bytes_rounded = int(round(float(num_bytes), - round_digits))
-            disk.capacity = bytes_rounded
-
-            tmp_capacity = line.split("[")[1].split("]")[0]
-            if tmp_capacity is not None:
-                disk.human_readable_capacity = tmp_capacity
-
-        elif "Rotation Rate:" in line:
-            if "Solid State Device" not in line:
-                disk.rotation_rate = int(line.split("Rotation Rate:")[1].split("rpm")[0].strip())
-                disk.type = "hdd"
+    disk = Disk()
+    health = SmartHealthReader()
+    section = None  # None before the information section, 'info' in it, 'data' after it
+    sata = False
+
+    for line in iter_lines(smartctl_output):
+        health.feed(line)
+        if 'SATA Version is:' in line:
+            sata = True
+        if section is None:
+            if '=== START OF INFORMATION SECTION ===' in line:
+                section = 'info'
+        elif section == 'info':
+            if '=== START OF READ SMART DATA SECTION ===' in line:
+                section = 'data'
             else:
-                disk.type = "ssd"
+                read_information(line, disk)
+
+    if section is None:
+        # Same as the split that used to be here, callers rely on it to spot files that aren't smartctl -x outputs
+        raise IndexError("No information section in the smartctl output")
+    health.apply(disk)
 
     if disk.brand == 'Western Digital':
         # These are useless and usually not even printed on labels and in bar codes...
@@ -277,12 +387,187 @@ def read_smartctl(smartctl_output):
 
     if 'SATA' in disk.family or 'SATA' in disk.model:
         disk.port = PORT.sata
-    if 'SATA Version is:' in smartctl_output:
+    if sata:
         disk.port = PORT.sata
 
     return disk
 
 
+def read_information(line: str, disk: Disk):
+    """
+    Reads a line of the information section of smartctl -x
+    """
+    if "Model Family:" in line:
+        line = line.split("Model Family:")[1].strip()
+        brand, family = split_brand_and_other(line)
+        disk.family = family
+        if brand is not None:
+            disk.brand = brand
+
+    elif "Model Number:" in line:
+        line = line.split("Model Number:")[1].strip()
+        brand, model = split_brand_and_other(line)
+        disk.model = model
+        if brand is not None:
+            disk.brand = brand
+
+    elif "Device Model:" in line:
+        line = line.split("Device Model:")[1].strip()
+        brand, model = split_brand_and_other(line)
+        disk.model = model
+        if brand is not None:
+            disk.brand = brand
+
+    elif "Serial Number:" in line:
+        disk.serial_number = normalize_sn(line.split("Serial Number:")[1].strip())
+
+    elif "LU WWN Device Id:" in line:
+        disk.wwn = line.split("LU WWN Device Id:")[1].strip()
+
+    elif "Form Factor:" in line:
+        ff = line.split("Form Factor:")[1].strip()
+        # https://github.com/smartmontools/smartmontools/blob/40468930fd77d681b034941c94dc858fe2c1ef10/smartmontools/ataprint.cpp#L405
+        if ff == '3.5 inches':
+            disk.form_factor = '3.5'
+        elif ff == '2.5 inches':
+            # This is the most common height, just guessing...
+            disk.form_factor = '2.5-7mm'
+        elif ff == '1.8 inches':
+            # Still guessing...
+            disk.form_factor = '1.8-8mm'
+        elif ff == 'M.2':
+            disk.form_factor = 'm2'
+
+    elif "User Capacity:" in line:
+        # https://stackoverflow.com/a/3411435
+        num_bytes = line.split('User Capacity:')[1].split("bytes")[0].strip().replace(',', '').replace('.',
+                                                                                                       '')
+        round_digits = int(floor(log10(abs(float(num_bytes))))) - 2
+        bytes_rounded = int(round(float(num_bytes), - round_digits))
+        disk.capacity = bytes_rounded
+
+        tmp_capacity = line.split("[")[1].split("]")[0]
+        if tmp_capacity is not None:
+            disk.human_readable_capacity = tmp_capacity
+
+    elif "Rotation Rate:" in line:
+        if "Solid State Device" not in line:
+            disk.rotation_rate = int(line.split("Rotation Rate:")[1].split("rpm")[0].strip())
+            disk.type = "hdd"
+        else:
+            disk.type = "ssd"
+
+
+def read_refresh(smartctl_output, disk: Disk) -> bool:
+    """
+    Reads the SMART status and attributes, the only parts that change between runs, from smartctl -i -H -A
+    The identifiers used to find a disk in the cache may belong to a USB dock rather than to the drive
+    in it, so the serial number and WWN reported by the drive itself must match too.
+    :param smartctl_output: the output as a string, or an iterable of lines (e.g. a pipe)
+    :return: False if it's another drive or it didn't tell which one it is, disk is left untouched then
+    """
+    try:
+        fresh = read_smartctl(smartctl_output)
+    except IndexError:
+        return False
+    if fresh.serial_number == '' or fresh.serial_number != disk.serial_number or fresh.wwn != disk.wwn:
+        return False
+    # Taken from a new Disk, so a missing health line or attribute table doesn't leave the old ones there
+    disk.smart_data = fresh.smart_data
+    disk.smart_data_long = fresh.smart_data_long
+    return True
+
+
+class SmartHealthReader:
+    """
+    Reads the SMART status and attributes one line at a time, keeping only what it needs
+    """
+    # The attribute table is kept for manual inspection later on, the first one has precedence
+    TABLES = ['Vendor Specific SMART Attributes with Thresholds:', 'SMART/Health Information']
+
+    def __init__(self):
+        self.tables = {}  # table title -> lines, up to the first empty one
+        self._reading = None  # title of the table being read
+        self.status = "not supported"
+        self.lacks_smart = False  # "SMART support is:" lines seen
+        self.has_smart = False
+
+    def feed(self, line: str):
+        if self._reading is not None:
+            if line == '':
+                self._reading = None
+            else:
+                self.tables[self._reading].append(line)
+        else:
+            for title in self.TABLES:
+                if title in line and title not in self.tables:
+                    self.tables[title] = [line[line.index(title):]]
+                    self._reading = title
+                    break
+
+        if "SMART overall-health" in line:
+            self.status = line.split(":")[1].strip()
+        elif "Device does not support Self Test logging" in line:
+            self.status = "not supported"
+        elif "SMART support is:" in line:
+            support = line.split("SMART support is:")[1].strip()
+            self.lacks_smart |= "device lacks SMART capability" in support
+            self.has_smart |= "device has SMART capability" in support
+
+    def apply(self, disk: Disk):
+        for title in self.TABLES:
+            if title in self.tables:
+                disk.smart_data_long = '\n'.join(self.tables[title])
+                break
+
+        if self.status == "PASSED":
+            # the disk is working fine
+            disk.smart_data = SMART.working
+
+        elif self.status == "FAILED!":
+            # the disk is not working fine
+            disk.smart_data = SMART.fail
+
+        elif self.status == "UNKNOWN!":
+            # the connection timed out, there could be different reasons
+            disk.smart_data = SMART.not_available
+
+        # TODO: throw a catastrophic fatal error of death if a disk has SMART disabled (can be enabled and disabled with smartctl to test and view the exact error message)
+
+        elif self.status == "not supported":
+            # the smart data need to be switched on or the smart capability is not supported
+            if self.lacks_smart:
+                # disk doesn't support smart capabilities
+                disk.smart_data = SMART.not_available
+            if self.has_smart:
+                # you need to enable smart capabilities
+                print("you need to enable smart capabilities on disk")
+                disk.smart_data = SMART.not_available
+
+
+def parse_attributes(table) -> dict:
+    """
+    :param table: ATA attribute table from smartctl (-A or -x format), as in Disk.smart_data_long
+    :return: {attribute ID: raw value}, raw values that aren't a number are skipped
+    """
+    result = {}
+    if not isinstance(table, str):
+        return result
+    for line in table.splitlines():
+        parts = line.split()
+        # ATA attribute IDs are a byte
+        if len(parts) < 8 or not parts[0].isdigit() or int(parts[0]) > 255:
+            continue
+        # -A: ID NAME FLAG VALUE WORST THRESH TYPE UPDATED WHEN_FAILED RAW...
+        # -x: ID NAME FLAGS VALUE WORST THRESH FAIL RAW...
+        raw = parts[9] if parts[2].startswith('0x') and len(parts) > 9 else parts[7]
+        # "36 (Min/Max 18/45)", "0/0" and similar: the first number is the one that counts
+        raw = raw.split('/')[0]
+        if raw.isdigit():
+            result[int(parts[0])] = int(raw)
+    return result
+
+
 def tarallo_conversion(disks: list):
     """
     Transforms list of disks in a format compatible to TARALLO
@@ -341,6 +626,18 @@ def tarallo_conversion(disks: list):
     return result
 
 
+def capacity(features: dict):
+    """
+    :param features: features of a disk, see tarallo_conversion
+    :return: capacity in bytes, None if unknown
+    """
+    # SSDs have capacity-byte, HDDs have capacity-decibyte
+    result = features.get('capacity-byte', features.get('capacity-decibyte'))
+    if result is None or result <= 0:
+        return None
+    return result
+
+
 def split_brand_and_other(line):
     lowered = line.lower()
 
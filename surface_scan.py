@@ -0,0 +1,249 @@
+"""
+Per-region timings of the badblocks surface scan
+badblocks only tells us if a disk passed or failed, so we follow its progress output and
+keep track of how long each fixed-size region of the disk took to be written and read back.
+Regions that are much slower than the rest of the disk usually mean retries and a disk that
+is about to die, even if badblocks didn't find any error (yet).
+"""
+
+import os
+import re
+import time
+from array import array
+from statistics import median
+
+REGION_SIZE = 1024**3  # 1 GiB
+MAX_REGIONS = 1000  # badblocks prints progress with 0.01% resolution, keep ~10 steps per region
+SLOW_FACTOR = 3  # a region is slow if its throughput is less than median / SLOW_FACTOR
+
+BLOCK_SIZE = 1024  # bytes, badblocks default: block numbers in its output are in these units
+MAX_LISTED = 20  # regions listed by name in the bad blocks summary
+
+PROGRESS = re.compile(r'(\d+\.\d+)% done')
+
+
+class Heatmap:
+    """
+    Seconds spent on each region of the disk, summed over every badblocks pass
+    """
+    def __init__(self, capacity: int, region_size: int = REGION_SIZE):
+        """
+        :param capacity: disk size in bytes, None if unknown: nothing is recorded then
+        :param region_size: minimum size of a region in bytes, it grows for huge disks
+        """
+        self.capacity = capacity or 0
+        self.region_size = max(region_size, -(-self.capacity // MAX_REGIONS))
+        self.seconds = array('f', [0.0]) * max(1, -(-self.capacity // self.region_size))
+        self._last = None  # (position in bytes, timestamp) of the last progress update
+        self._paused = 0.0  # seconds spent paused, they don't count as time spent on a region
+        self._paused_since = None
+
+    def pause(self, timestamp: float):
+        self._paused_since = timestamp
+
+    def resume(self, timestamp: float):
+        if self._paused_since is not None:
+            self._paused += timestamp - self._paused_since
+            self._paused_since = None
+
+    def record(self, fraction: float, timestamp: float):
+        """
+        Adds a progress update, the time since the previous one is spread over the regions covered
+        :param fraction: position of badblocks in the current pass, from 0 to 1
+        :param timestamp: when the update was received, in seconds
+        """
+        if self.capacity == 0:
+            # No way to tell which region badblocks is in
+            return
+        position = min(int(fraction * self.capacity), self.capacity)
+        if self._paused_since is not None:
+            timestamp = self._paused_since
+        timestamp -= self._paused
+        if self._last is None or position < self._last[0]:
+            # First update or a new pass started from the beginning of the disk
+            self._last = (position, timestamp)
+            return
+
+        start, last_timestamp = self._last
+        self._spread(start, position, timestamp - last_timestamp)
+        self._last = (position, timestamp)
+
+    def _spread(self, start: int, end: int, seconds: float):
+        last_region = len(self.seconds) - 1
+        if end == start:
+            # No progress at all: badblocks is stuck retrying in this region
+            self.seconds[min(start // self.region_size, last_region)] += seconds
+            return
+
+        for i in range(start // self.region_size, min((end - 1) // self.region_size, last_region) + 1):
+            low = max(start, i * self.region_size)
+            high = min(end, (i + 1) * self.region_size)
+            self.seconds[i] += seconds * (high - low) / (end - start)
+
+    def region_bytes(self, i: int) -> int:
+        return min(self.region_size, self.capacity - i * self.region_size)
+
+    def throughput(self) -> list:
+        """
+        :return: MB/s for each region, None for regions that weren't scanned
+        """
+        result = []
+        for i, seconds in enumerate(self.seconds):
+            if seconds > 0:
+                result.append(self.region_bytes(i) / seconds / 1000**2)
+            else:
+                result.append(None)
+        return result
+
+    def median_throughput(self):
+        """
+        :return: MB/s of the median region, None if no region was scanned
+        """
+        measured = [t for t in self.throughput() if t is not None]
+        if len(measured) == 0:
+            return None
+        return median(measured)
+
+    def slow_regions(self, factor: float = SLOW_FACTOR) -> list:
+        """
+        :return: indexes of the regions with a throughput lower than median / factor
+        """
+        throughput = self.throughput()
+        middle = self.median_throughput()
+        if middle is None:
+            return []
+        threshold = middle / factor
+        return [i for i, t in enumerate(throughput) if t is not None and t < threshold]
+
+    def summary(self) -> str:
+        """
+        Human readable histogram of the throughput, relative to the median region
+        """
+        throughput = self.throughput()
+        measured = [t for t in throughput if t is not None]
+        if len(measured) == 0:
+            return "Surface scan: no timing information"
+        middle = median(measured)
+
+        buckets = [('>= 90%', 0.9), ('75-90%', 0.75), ('50-75%', 0.5), ('25-50%', 0.25), ('< 25%', 0)]
+        counts = [0] * len(buckets)
+        for t in measured:
+            for j, (_, low) in enumerate(buckets):
+                if t >= middle * low:
+                    counts[j] += 1
+                    break
+
+        lines = [f"Surface scan: {len(self.seconds)} regions of {self.region_size // 1024**2} MiB, "
+                 f"median {middle:.1f} MB/s"]
+        for (label, _), count in zip(buckets, counts):
+            lines.append(f"  {label} of median: {count}")
+        slow = self.slow_regions()
+        if slow:
+            lines.append(f"Slow regions (< 1/{SLOW_FACTOR} of median): " + ', '.join(str(i) for i in slow))
+        return '\n'.join(lines)
+
+    def save(self, path: str):
+        """
+        Writes the raw array (float32 seconds per region, native byte order)
+        """
+        with open(path, 'wb') as f:
+            self.seconds.tofile(f)
+
+
+def read_progress(stream):
+    """
+    Yields the progress of badblocks -s, as a fraction between 0 and 1
+    badblocks rewrites the same line with backspaces, so the output is split on those too
+    :param stream: binary stream with the stderr of badblocks
+    """
+    fd = stream.fileno()
+    buffer = ''
+    while True:
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            break
+        tokens = re.split(r'[\b\r\n]+', buffer + chunk.decode(errors='replace'))
+        buffer = tokens.pop()
+        for token in tokens:
+            match = PROGRESS.search(token)
+            if match:
+                yield float(match.group(1)) / 100
+
+    match = PROGRESS.search(buffer)
+    if match:
+        yield float(match.group(1)) / 100
+
+
+def follow(stream, heatmap: Heatmap, callback=None):
+    """
+    Records the progress of badblocks in the heatmap until the stream is closed
+    :param callback: called with each progress update, if set
+    """
+    for fraction in read_progress(stream):
+        heatmap.record(fraction, time.monotonic())
+        if callback is not None:
+            callback(fraction)
+
+
+def iter_bad_blocks(path: str):
+    """
+    Yields the block numbers in a badblocks output file (-o), one at a time
+    A dying disk can have millions of them, so the file is never read whole.
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.isdigit():
+                yield int(line)
+
+
+def bad_block_ranges(blocks):
+    """
+    Merges runs of consecutive blocks, badblocks lists them in increasing order
+    :param blocks: iterable of block numbers
+    :return: generator of (first block, number of blocks)
+    """
+    start = None
+    count = 0
+    for block in blocks:
+        if start is not None and block == start + count:
+            count += 1
+            continue
+        if start is not None:
+            yield start, count
+        start, count = block, 1
+    if start is not None:
+        yield start, count
+
+
+def bad_blocks_summary(path: str, heatmap: Heatmap = None) -> str:
+    """
+    Human readable summary of a badblocks output file, in constant memory (apart from the
+    regions, which are at most MAX_REGIONS)
+    :param heatmap: if set, the regions of the heatmap with bad blocks are listed too
+    """
+    blocks = 0
+    ranges = 0
+    first = last = None
+    regions = set()
+    for start, count in bad_block_ranges(iter_bad_blocks(path)):
+        blocks += count
+        ranges += 1
+        if first is None:
+            first = start
+        last = start + count - 1
+        if heatmap is not None:
+            last_region = len(heatmap.seconds) - 1
+            for region in range(start * BLOCK_SIZE // heatmap.region_size,
+                                min(last * BLOCK_SIZE // heatmap.region_size, last_region) + 1):
+                regions.add(region)
+    if blocks == 0:
+        return "Bad blocks: none"
+
+    summary = f"Bad blocks: {blocks} in {ranges} ranges, from block {first} to {last} ({BLOCK_SIZE} bytes each)"
+    if regions:
+        listed = ', '.join(str(r) for r in sorted(regions)[:MAX_LISTED])
+        if len(regions) > MAX_LISTED:
+            listed += f" and {len(regions) - MAX_LISTED} more"
+        summary += f"\nRegions with bad blocks: {listed}"
+    return summary
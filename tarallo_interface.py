@@ -1,9 +1,50 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 from pytarallo import Tarallo, Errors, Item
 
+MAX_CONCURRENCY = 8  # requests in flight at once, each one on its own keep-alive session
+RETRIES = 3
+BACKOFF = 0.5  # seconds before the first retry, doubled at each one
+
+# Failures worth retrying: the server or the network may be fine a moment later
+TRANSIENT_ERRORS = (Errors.ServerError, requests.ConnectionError, requests.Timeout)
+
+# Features that change every time a disk is checked or wiped: a different value is not a conflict,
+# it gets updated instead
+VOLATILE_FEATURES = ['smart-data', 'smart-data-long', 'working', 'notes', 'data-erased', 'surface-scan']
+
 
 class TaralloInterface:
-    def __init__(self, instance=None):
+    """
+    Thread safe T.A.R.A.L.L.O. client
+    Calls go through a pool of pytarallo sessions, so that up to max_concurrency of them can be
+    in flight at once (e.g. one per disk) while reusing their connections. Idempotent calls are
+    retried with exponential backoff, and the latency of every call is counted in stats.
+    """
+    def __init__(self, instance=None, max_concurrency: int = MAX_CONCURRENCY, retries: int = RETRIES,
+                 backoff: float = BACKOFF):
+        """
+        :param instance: pytarallo instance to use, more sessions to the same server are opened as needed
+        :param max_concurrency: maximum number of requests in flight at once
+        :param retries: times an idempotent call is repeated after a transient failure
+        :param backoff: seconds before the first retry
+        """
         self.instance = instance
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = {}  # call name -> {'calls', 'retries', 'errors', 'seconds', 'max'}
+        self._sessions = queue.LifoQueue()  # idle sessions, most recently used first to keep connections warm
+        self._sessions_open = 0
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        if instance is not None:
+            self._sessions.put(instance)
+            self._sessions_open = 1
 
     def connect(self, url: str, token: str):
         if self.instance is not None:
@@ -11,14 +52,112 @@ class TaralloInterface:
             return False
 
         print("Trying to connect to the T.A.R.A.L.L.O. database")
+        if not url or not token:
+            print('Failed to connect to the database: missing TARALLO_URL or TARALLO_TOKEN')
+            return False
+        self.instance = Tarallo.Tarallo(url, token)
+        self._sessions.put(self.instance)
+        self._sessions_open = 1
         try:
-            self.instance = Tarallo.Tarallo(url, token)
-        except:
-            print('Failed to connect to the database')
+            status = self._call('status')
+        except (Errors.AuthenticationError, Errors.ServerError, requests.RequestException) as e:
+            # RequestException covers a wrong URL too (e.g. without http://)
+            print(f'Failed to connect to the database: {e!r}')
+            self._disconnect()
+            return False
+        if status != 200:
+            print(f'Failed to connect to the database: HTTP status code {status}')
+            self._disconnect()
             return False
         print("Successfully connected to the database")
         return True
 
+    def _disconnect(self):
+        # Forget the session that failed, so that connect can be tried again
+        self.instance = None
+        self._sessions = queue.LifoQueue()
+        self._sessions_open = 0
+
+    def _lease(self):
+        try:
+            return self._sessions.get_nowait()
+        except queue.Empty:
+            # Every session is busy, but there's a free slot: open another one
+            with self._lock:
+                self._sessions_open += 1
+            return Tarallo.Tarallo(self.instance.url, self.instance.token)
+
+    def _call(self, name: str, *args, idempotent: bool = True):
+        """
+        Calls a pytarallo method on a free session
+        :param name: name of the method
+        :param idempotent: whether it's safe to repeat the call after a transient failure
+        """
+        with self._slots:
+            session = self._lease()
+            try:
+                attempt = 0
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        result = getattr(session, name)(*args)
+                        self._count(name, time.perf_counter() - start, retry=attempt > 0)
+                        return result
+                    except Errors.ValidationError as e:
+                        # Not transient, but who catches it wants to know why
+                        self._count(name, time.perf_counter() - start, retry=attempt > 0, error=True)
+                        e.response = session.response
+                        raise
+                    except TRANSIENT_ERRORS:
+                        self._count(name, time.perf_counter() - start, retry=attempt > 0, error=True)
+                        if not idempotent or attempt >= self.retries:
+                            raise
+                        time.sleep(self.backoff * 2 ** attempt)
+                        attempt += 1
+            finally:
+                self._sessions.put(session)
+
+    def _count(self, name: str, seconds: float, retry: bool = False, error: bool = False):
+        with self._lock:
+            stats = self.stats.setdefault(name, {'calls': 0, 'retries': 0, 'errors': 0, 'seconds': 0.0, 'max': 0.0})
+            stats['calls'] += 1
+            stats['retries'] += int(retry)
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+    def stats_summary(self) -> str:
+        """
+        Human readable latency of the calls done so far
+        """
+        lines = [f"T.A.R.A.L.L.O. calls ({self._sessions_open} sessions):"]
+        with self._lock:
+            for name, stats in sorted(self.stats.items()):
+                lines.append(f"  {name}: {stats['calls']} calls, avg {stats['seconds'] / stats['calls'] * 1000:.0f} ms, "
+                             f"max {stats['max'] * 1000:.0f} ms, {stats['retries']} retries, {stats['errors']} errors")
+        return '\n'.join(lines)
+
+    def get_codes(self, feature: str, value) -> list:
+        return self._call('get_codes_by_feature', feature, value)
+
+    def get_features(self, code: str) -> dict:
+        return self._call('get_item', code).features
+
+    def update_features(self, code: str, features: dict):
+        # PATCH sets features to a value, doing it twice is harmless
+        return self._call('update_features', code, features)
+
+    def remove_item(self, code: str):
+        return self._call('remove_item', code)
+
+    def add_disks(self, disks: list) -> list:
+        """
+        Adds or updates many disks at once, up to max_concurrency in parallel
+        :return: result of add_disk for each disk
+        """
+        with ThreadPoolExecutor(self.max_concurrency) as pool:
+            return list(pool.map(self.add_disk, disks))
+
     def add_disk(self, disk: dict) -> bool:
         """
         Adds or updates disk to Tarallo database
@@ -40,20 +179,21 @@ class TaralloInterface:
                 item = Item.Item()
                 item.features = disk
                 item.location = 'Polito'  # TODO: maybe it can be set from config or a better default should be picked
-                self.instance.add_item(item=item)
+                # Not idempotent: a retry after the server saved the item would add a duplicate
+                self._call('add_item', item, idempotent=False)
             elif duplicates == 1:
                 # TODO: to avoid checking twice the database for the disk we could return the code from check_duplicates
                 self.update_disk(disk)
             print("Item inserted successfully")
-        except Errors.ValidationError:
+        except Errors.ValidationError as e:
             # Simply return False and don't crash if there's some error
             print("Item not inserted")
-            response = self.instance.response
+            response = e.response
             print("HTTP status code:", response.status_code, "\n" + response.json()['message'])
             return False
 
         print("Successfully added the disk")
-        print("Disk code on the Database: " + self.instance.get_codes_by_feature('sn', disk['sn'])[0])
+        print("Disk code on the Database: " + self.get_codes('sn', disk['sn'])[0])
         return True
 
     def check_duplicate(self, disk: dict) -> int:
@@ -66,7 +206,7 @@ class TaralloInterface:
         """
 
         print("\nSearching the T.A.R.A.L.L.O. databse for disk with serial number {}".format(disk['sn']))
-        disk_code = self.instance.get_codes_by_feature('sn', disk['sn'])
+        disk_code = self.get_codes('sn', disk['sn'])
 
         # if there's already more than 1 corresponding disk in the TARALLO, don't add
         if len(disk_code) > 1:
@@ -77,12 +217,12 @@ class TaralloInterface:
         elif len(disk_code) == 1:
             print(f"Disk with serial number {disk['sn']} already present in the database"
                   f"with the code {disk_code[0]}")
-            item = self.instance.get_item(disk_code[0])
+            remote = self.get_features(disk_code[0])
             # checking for conflicing features
-            for key, value in item.features.items():
-                if key == 'smart-data' or key == 'smart-data-long':
+            for key, value in remote.items():
+                if key in VOLATILE_FEATURES:
                     continue  # we don't care if it has a different status
-                if value != disk[key]:
+                if key in disk and value != disk[key]:
                     print("There's a conflict in the database for this disk")
                     print("Won't proceed until conflict is solved")
                     return -1
@@ -93,18 +233,20 @@ class TaralloInterface:
             return 0
 
     def update_disk(self, disk):
-        code = self.instance.get_codes_by_feature('sn', disk['sn'])[0]
-        remote = self.instance.get_item(code).features
+        code = self.get_codes('sn', disk['sn'])[0]
+        remote = self.get_features(code)
 
         upload = {}
 
         for feature_to_upload in ['brand', 'model', 'variant', 'capacity-decibyte', 'spin-rate-rpm', 'sn', 'wwn',
-                                  'form-factor-hdd', 'type']:
+                                  'hdd-form-factor', 'type']:
             if feature_to_upload not in remote and feature_to_upload in disk:
-                upload[feature_to_upload] += disk[feature_to_upload]
-            if upload:
-                self.instance.update_features(code, upload)
-
+                upload[feature_to_upload] = disk[feature_to_upload]
+        for feature_to_upload in VOLATILE_FEATURES:
+            if feature_to_upload in disk and remote.get(feature_to_upload) != disk[feature_to_upload]:
+                upload[feature_to_upload] = disk[feature_to_upload]
+        if upload:
+            self.update_features(code, upload)
 
     def get_instance(self):
         """Returns an instance of the tarallo connection if interested in acting on that manually"""
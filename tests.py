@@ -1,20 +1,63 @@
 import os
+import sys
 import subprocess as sp
 from dotenv import load_dotenv
 from pytarallo.Tarallo import Tarallo, Item
 from tarallo_interface import TaralloInterface
 from pytarallo.Errors import *
 import turbofresa
+import surface_scan
+import thermal
+import metadata_wipe
+import backfill
+import fleet
+import run_status
+import benchmarks
 from smartctl_parser import parse_disks, SMART
+import smartctl_parser
+from fake_tarallo import FakeTarallo
+from aggregator import Aggregator, Agent
 
 from nose.plugins.skip import SkipTest
 
 
+def smartctl_output(serial: str = 'Z3T0ABCD', model: str = 'ST500DM002-1BD142', wwn: str = '5 000c50 06e0a1b2c',
+                    attributes: int = 2) -> str:
+    """Fake smartctl -x output of a SATA hard drive"""
+    table = [
+        "  5 Reallocated_Sector_Ct   PO--CK   100   100   036    -    0",
+        "194 Temperature_Celsius     -O---K   036   045   000    -    36 (Min/Max 18/45)",
+    ]
+    table += [f"{200 + i % 50:3d} Vendor_Specific_{i:<8d} -O--CK   100   100   000    -    {i}" for i in range(attributes - 2)]
+    return "\n".join([
+        "smartctl 7.1 2019-12-30 r5022 [x86_64-linux-5.4.0] (local build)",
+        "",
+        "=== START OF INFORMATION SECTION ===",
+        "Model Family:     Seagate Barracuda 7200.14 (AF)",
+        "Device Model:     " + model,
+        "Serial Number:    " + serial,
+        "LU WWN Device Id: " + wwn,
+        "User Capacity:    500,107,862,016 bytes [500 GB]",
+        "Rotation Rate:    7200 rpm",
+        "Form Factor:      3.5 inches",
+        "SATA Version is:  SATA 3.0, 6.0 Gb/s (current: 6.0 Gb/s)",
+        "SMART support is: Available - device has SMART capability.",
+        "",
+        "=== START OF READ SMART DATA SECTION ===",
+        "SMART overall-health self-assessment test result: PASSED",
+        "",
+        "SMART Attributes Data Structure revision number: 10",
+        "Vendor Specific SMART Attributes with Thresholds:",
+        "ID# ATTRIBUTE_NAME          FLAGS    VALUE WORST THRESH FAIL RAW_VALUE",
+    ] + table + ["", ""])
+
+
 class Test_Tarallo:
     """Verify functioning of TaralloInterface"""
 
     # !!!WARNING!!!
     # Only run this on a test version of the TARALLO!!!
+    # If no TARALLO is reachable, the tests run against a local FakeTarallo
 
     @classmethod
     def setup_class(cls):
@@ -47,10 +90,22 @@ class Test_Tarallo:
             else:
                 cls.connected = False
         finally:
+            cls.fake = None
             if cls.connected is False:
-                print("Couldn't connect to tarallo server")
-            else:
-                cls.tarallo_interface = TaralloInterface(cls.tarallo_instance)
+                print("Couldn't connect to tarallo server, using a fake one")
+                cls.fake = FakeTarallo()
+                cls.tarallo_instance = Tarallo(cls.fake.start(), cls.fake.token)
+                cls.connected = cls.tarallo_instance.status() == 200
+            cls.tarallo_interface = TaralloInterface(cls.tarallo_instance)
+
+    @classmethod
+    def teardown_class(cls):
+        if cls.fake is not None:
+            cls.fake.stop()
+
+    def setup_method(self, method):
+        # pytest doesn't call nose-style setup() anymore
+        self.setup()
 
     def setup(self):
         if not self.connected:
@@ -142,6 +197,787 @@ class Test_Tarallo:
         assert self.tarallo_interface.add_disk(disk) is True
 
 
+class Test_Streaming:
+    """Verify that smartctl outputs and badblocks logs are read line by line"""
+
+    def setup_method(self, method):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+
+    def teardown_method(self, method):
+        self.directory.cleanup()
+
+    def test_read_smartctl_lines(self):
+        output = smartctl_output(attributes=5)
+        path = os.path.join(self.directory.name, 'smartctl.txt')
+        with open(path, 'w') as f:
+            f.write(output)
+        with open(path) as f:
+            streamed = smartctl_parser.read_smartctl(f)
+        assert vars(streamed) == vars(smartctl_parser.read_smartctl(output))
+        assert vars(streamed) == vars(smartctl_parser.read_smartctl(output.replace('\n', '\r\n')))
+        assert streamed.smart_data_long.startswith('Vendor Specific SMART Attributes with Thresholds:')
+        assert streamed.smart_data_long.endswith('Vendor_Specific_2        -O--CK   100   100   000    -    2')
+        try:
+            smartctl_parser.read_smartctl(iter(['Not a smartctl output']))
+        except IndexError:
+            pass
+        else:
+            raise AssertionError("Invalid output accepted")
+
+    def test_bad_blocks(self):
+        path = os.path.join(self.directory.name, 'badblocks.txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(str(b) for b in [10, 11, 12, 20, 1048576, 1048577]) + '\n')
+        assert list(surface_scan.bad_block_ranges(surface_scan.iter_bad_blocks(path))) == [(10, 3), (20, 1), (1048576, 2)]
+        heatmap = surface_scan.Heatmap(4 * 1024**3)
+        summary = surface_scan.bad_blocks_summary(path, heatmap)
+        assert 'Bad blocks: 6 in 3 ranges, from block 10 to 1048577' in summary
+        assert 'Regions with bad blocks: 0, 1' in summary
+
+        open(path, 'w').close()
+        assert surface_scan.bad_blocks_summary(path) == "Bad blocks: none"
+
+    def test_bounded_memory(self):
+        import tracemalloc
+        path = os.path.join(self.directory.name, 'badblocks.txt')
+        with open(path, 'w') as f:
+            for block in range(0, 400000, 2):
+                f.write(f"{block}\n")
+        tracemalloc.start()
+        try:
+            summary = surface_scan.bad_blocks_summary(path)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert 'Bad blocks: 200000 in 200000 ranges' in summary
+        # The file is more than 2 MB
+        assert peak < 256 * 1024, f"Peak memory {peak} bytes"
+
+    def test_parse_attributes(self):
+        disk = smartctl_parser.read_smartctl(smartctl_output(attributes=4))
+        assert smartctl_parser.parse_attributes(disk.smart_data_long) == {5: 0, 194: 36, 200: 0, 201: 1}
+        table = "194 Temperature_Celsius 0x0022 036 045 000 Old_age Always - 36 (Min/Max 18/45)"
+        assert smartctl_parser.parse_attributes(table) == {194: 36}
+        # Cut short, the raw value of the -A format isn't there
+        assert smartctl_parser.parse_attributes("194 Temperature_Celsius 0x0022 036 045 000 Old_age Always -") == {}
+        assert smartctl_parser.parse_attributes(smartctl_parser.SMART.not_available) == {}
+
+
+class Test_SmartCache:
+    """Verify that parsed disks are reused and their SMART status refreshed"""
+
+    def setup_method(self, method):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache.json')
+        self.disk = smartctl_parser.Disk()
+        self.disk.type = 'hdd'
+        self.disk.brand = 'Seagate'
+        self.disk.model = 'ST500DM002'
+        self.disk.serial_number = 'Z3T0ABCD'
+        self.disk.capacity = 500000000000
+        self.disk.port = smartctl_parser.PORT.sata
+        self.disk.smart_data = SMART.working
+
+    def teardown_method(self, method):
+        self.directory.cleanup()
+
+    def test_identity(self):
+        device = {'name': 'sdb', 'serial': 'Z3T0ABCD', 'wwn': '0x5000c5006e0a1b2c', 'by-id': ''}
+        cache = smartctl_parser.SmartCache(self.path, ttl=60)
+        cache.put(smartctl_parser.identity_keys(device), self.disk)
+        cache.save()
+
+        # Same disk behind a USB bridge that only reports the WWN, on another port
+        moved = {'name': 'sdc', 'serial': '', 'wwn': '0x5000c5006e0a1b2c', 'by-id': '/dev/disk/by-id/usb-X'}
+        disk = smartctl_parser.SmartCache(self.path, ttl=60).get(smartctl_parser.identity_keys(moved))
+        assert disk is not None
+        assert disk.serial_number == 'Z3T0ABCD'
+        assert disk.port == smartctl_parser.PORT.sata
+        assert disk.smart_data == SMART.working
+        assert disk.smart_data_long == SMART.not_available
+
+        other = {'name': 'sdc', 'serial': 'OTHER', 'wwn': '', 'by-id': ''}
+        assert smartctl_parser.SmartCache(self.path, ttl=60).get(smartctl_parser.identity_keys(other)) is None
+
+    def test_ttl(self):
+        keys = ['serial:Z3T0ABCD']
+        cache = smartctl_parser.SmartCache(self.path, ttl=60)
+        cache.put(keys, self.disk)
+        cache.entries[0]['time'] -= 120
+        assert cache.get(keys) is None
+        assert smartctl_parser.SmartCache(self.path, ttl=0).get(keys) is None
+
+    def test_refresh_keeps_ttl(self):
+        keys = ['serial:Z3T0ABCD']
+        cache = smartctl_parser.SmartCache(self.path, ttl=60)
+        cache.put(keys, self.disk)
+        cache.entries[0]['time'] -= 50
+        # Seen again and refreshed, but the full parse is still 50 seconds old
+        disk = cache.get(keys)
+        assert disk is not None
+        cache.put(keys, disk, refreshed=True)
+        assert len(cache.entries) == 1
+        cache.entries[0]['time'] -= 20
+        assert cache.get(keys) is None
+
+    def refresh_output(self, serial='Z3T0ABCD', health='FAILED!'):
+        output = (
+            "=== START OF INFORMATION SECTION ===\n"
+            "Device Model:     ST500DM002-1BD142\n"
+            f"Serial Number:    {serial}\n"
+            "\n"
+            "=== START OF READ SMART DATA SECTION ===\n"
+        )
+        if health is not None:
+            output += f"SMART overall-health self-assessment test result: {health}\n\n"
+        return output + (
+            "Vendor Specific SMART Attributes with Thresholds:\n"
+            "  5 Reallocated_Sector_Ct   0x0033   001   001   036    Pre-fail  Always   FAILING_NOW 4000\n"
+            "\n"
+        )
+
+    def test_refresh_health(self):
+        assert smartctl_parser.read_refresh(self.refresh_output(), self.disk)
+        assert self.disk.smart_data == SMART.fail
+        assert 'Reallocated_Sector_Ct' in self.disk.smart_data_long
+        assert smartctl_parser.tarallo_conversion([self.disk])[0]['features']['working'] == 'no'
+
+    def test_refresh_other_disk(self):
+        # Another disk in the same USB dock, which has the serial number and by-id link of the dock
+        assert not smartctl_parser.read_refresh(self.refresh_output(serial='W1E0WXYZ'), self.disk)
+        assert self.disk.smart_data == SMART.working
+        assert self.disk.smart_data_long == SMART.not_available
+        # Nothing from -i, the drive can't be told apart
+        output = "SMART overall-health self-assessment test result: PASSED\n"
+        assert not smartctl_parser.read_refresh(output, self.disk)
+        assert self.disk.smart_data == SMART.working
+
+    def test_refresh_no_health(self):
+        self.disk.smart_data_long = 'stale attributes'
+        assert smartctl_parser.read_refresh(self.refresh_output(health=None), self.disk)
+        assert self.disk.smart_data == SMART.not_available
+        assert 'Reallocated_Sector_Ct' in self.disk.smart_data_long
+
+
+class Test_Thermal:
+    """Verify temperature readings and throttling"""
+
+    def test_parse_temperature(self):
+        attributes = (
+            "ID# ATTRIBUTE_NAME          FLAG     VALUE WORST THRESH TYPE      UPDATED  WHEN_FAILED RAW_VALUE\n"
+            "190 Airflow_Temperature_Cel 0x0022   064   050   045    Old_age   Always       -       36\n"
+            "194 Temperature_Celsius     0x0022   036   045   000    Old_age   Always       -       38 (Min/Max 18/45)\n"
+        )
+        assert thermal.parse_temperature(attributes) == 38
+        brief = "194 Temperature_Celsius     -O---K   036   045   000    -    41 (Min/Max 18/45)\n"
+        assert thermal.parse_temperature(brief) == 41
+        assert thermal.parse_temperature("Temperature:                        35 Celsius\n") == 35
+        assert thermal.parse_temperature("Current Drive Temperature:     33 C\n") == 33
+        assert thermal.parse_temperature("SMART support is: Unavailable\n") is None
+        assert thermal.parse_temperature("194 Temperature_Celsius 0x0022 036 045 000 Old_age Always -\n") is None
+
+    def test_throttle(self):
+        throttle = thermal.Throttle(max_temperature=50, hysteresis=5)
+        assert throttle.update(45, 0) is None
+        assert throttle.update(52, 30) == 'pause'
+        assert throttle.update(48, 60) is None
+        assert throttle.throttled_seconds(60) == 30
+        assert throttle.update(45, 90) == 'resume'
+        assert throttle.update(None, 120) is None
+        assert throttle.peak == 52
+        assert throttle.throttled == 60
+
+    def test_heatmap_pause(self):
+        heatmap = surface_scan.Heatmap(1000, region_size=100)
+        heatmap.record(0, 0)
+        heatmap.record(0.5, 50)
+        heatmap.pause(50)
+        heatmap.resume(150)
+        heatmap.record(1, 200)
+        assert heatmap.slow_regions() == []
+        assert sum(heatmap.seconds) == 100
+
+
+class Test_MetadataWipe:
+    """Verify the regions overwritten before the full wipe"""
+
+    def test_task_goes_on(self):
+        import queue
+
+        def broken(mount_point):
+            raise FileNotFoundError("/sys/block/sdz/size")
+
+        results = queue.Queue()
+        task = turbofresa.Task({'mount_point': 'sdz', 'features': {}}, results, metadata_first=True)
+        destroy_metadata = metadata_wipe.destroy_metadata
+        metadata_wipe.destroy_metadata = broken
+        try:
+            status = {}
+            task.destroy_metadata(status)
+        finally:
+            metadata_wipe.destroy_metadata = destroy_metadata
+        assert status['metadata-destroyed'] is False
+        event = results.get_nowait()
+        assert event['event'] == 'metadata-destroyed' and event['success'] is False
+        assert 'sdz' in event['error']
+
+    def test_whole_disk(self):
+        mib = metadata_wipe.MIB
+        size = 500 * metadata_wipe.GIB
+        regions = metadata_wipe.metadata_regions(size)
+        assert regions[0] == (0, mib)
+        assert regions[-1] == (size - mib, mib)
+        assert (64 * mib, 4096) in regions
+        assert (256 * metadata_wipe.GIB, 4096) in regions
+        assert (128 * mib, 4096) in regions
+        for (offset, length), (next_offset, _) in zip(regions, regions[1:]):
+            assert offset + length < next_offset
+
+    def test_partitions(self):
+        mib = metadata_wipe.MIB
+        size = 100 * mib
+        # The first partition starts right after the first MiB, so the two regions get merged
+        regions = metadata_wipe.metadata_regions(size, [(mib, 49 * mib), (50 * mib, 50 * mib)])
+        assert regions[0] == (0, 2 * mib)
+        assert (49 * mib, 2 * mib) in regions
+        assert regions[-1] == (99 * mib, mib)
+        assert all(offset + length <= size for offset, length in regions)
+
+    def test_tiny_disk(self):
+        assert metadata_wipe.metadata_regions(4096) == [(0, 4096)]
+
+
+class Test_Backfill:
+    """Verify the re-ingestion of archived smartctl outputs"""
+
+    def setup_method(self, method):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        for i in range(5):
+            with open(os.path.join(self.directory.name, f'BACKFILL{i}.txt'), 'w') as f:
+                f.write(smartctl_output(serial=f'BACKFILL{i}', wwn=f'5 000c50 0{i:08x}'))
+        with open(os.path.join(self.directory.name, 'garbage.txt'), 'w') as f:
+            f.write("smartctl: command not found\n")
+        # Parsing errors in a single file
+        broken = {
+            'rotation.txt': smartctl_output(serial='ROTATION').replace('7200 rpm', 'Unknown (0x0401)'),
+            'capacity.txt': smartctl_output(serial='CAPACITY').replace('500,107,862,016 bytes [500 GB]', '0 bytes [0 B]'),
+        }
+        for name, content in broken.items():
+            with open(os.path.join(self.directory.name, name), 'w') as f:
+                f.write(content)
+        with open(os.path.join(self.directory.name, 'corrupted.txt'), 'wb') as f:
+            f.write(smartctl_output(serial='CORRUPTED').encode() + b'\xff\xfe\x80\n')
+        with open(os.path.join(self.directory.name, 'BACKFILL0.heatmap'), 'wb') as f:
+            f.write(b'\0' * 16)
+
+    def teardown_method(self, method):
+        self.directory.cleanup()
+
+    def test_parse_archive(self):
+        parsed = dict(backfill.parse_archive(self.directory.name, workers=2))
+        assert len(parsed) == 9
+        for name in ['garbage.txt', 'rotation.txt', 'capacity.txt', 'corrupted.txt']:
+            assert parsed[os.path.join(self.directory.name, name)] is None
+        features = parsed[os.path.join(self.directory.name, 'BACKFILL3.txt')]
+        assert features['sn'] == 'BACKFILL3'
+        assert features['brand'] == 'Seagate'
+        assert features['hdd-form-factor'] == '3.5'
+
+    def test_backfill(self):
+        parsed = backfill.parse_archive(self.directory.name, workers=2)
+        with FakeTarallo() as fake:
+            tarallo = TaralloInterface(Tarallo(fake.url, fake.token))
+            # Parsed by an older version of the parser
+            old = dict(dict(parsed)[os.path.join(self.directory.name, 'BACKFILL1.txt')])
+            old['model'] = 'OLD MODEL'
+            old['working'] = 'maybe'
+            code = fake.add_item(old)
+            fake.add_item(dict(old, sn='BACKFILL2'))
+            fake.add_item(dict(old, sn='BACKFILL2'))
+            unchanged = fake.add_item(dict(parsed)[os.path.join(self.directory.name, 'BACKFILL4.txt')])
+
+            counts = backfill.backfill(tarallo, parsed, dry_run=True, batch_size=2, interactive=False)
+            assert counts == {'invalid': 4, 'missing': 2, 'conflict': 1, 'unchanged': 1, 'changed': 1}
+            assert fake.items[code]['features']['model'] == 'OLD MODEL'
+
+            fake.reset_counters()
+            backfill.backfill(tarallo, parsed, batch_size=2, interactive=False)
+            assert fake.items[code]['features']['model'] == 'ST500DM002-1BD142'
+            # Wiping results are more recent than the archive
+            assert fake.items[code]['features']['working'] == 'maybe'
+            assert fake.requests['PATCH'] == 1
+            assert fake.items[unchanged]['features']['sn'] == 'BACKFILL4'
+
+
+class Test_Fleet:
+    """Verify the columnar history of the processed disks"""
+
+    def setup_method(self, method):
+        import tempfile
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest("NumPy is not installed")
+        self.directory = tempfile.TemporaryDirectory()
+
+    def teardown_method(self, method):
+        self.directory.cleanup()
+
+    def test_shards(self):
+        rows = []
+        for i in range(30):
+            features = {'sn': f'FLEET{i:03d}', 'model': 'BAD' if i % 3 == 0 else 'GOOD', 'type': 'hdd',
+                        'capacity-decibyte': 500000000000, 'working': 'yes'}
+            rows.append(fleet.make_row(features, {'throughput': 120.5, 'elapsed-seconds': 3600},
+                                       {5: i, 194: 30}, success=i % 3 != 0))
+        fleet.write_shard(rows[:20], self.directory.name)
+        fleet.write_shard(rows[20:] + [fleet.make_row({'sn': 'CRASH', 'model': 'GOOD'}, {}, {}, False)],
+                          self.directory.name)
+        assert fleet.write_shard([], self.directory.name) is None
+
+        data = fleet.load(self.directory.name)
+        assert len(data['sn']) == 31
+        assert data['attributes'].shape == (31, fleet.ATTRIBUTES)
+        assert list(fleet.failure_rates(data)) == [('BAD', 10, 10, 1.0), ('GOOD', 21, 1, 1 / 21)]
+        reallocated = fleet.attribute(data, 5)
+        assert reallocated.count() == 30
+        assert reallocated.sum() == sum(range(30))
+
+        assert fleet.compact(self.directory.name) is not None
+        assert len(fleet.shards(self.directory.name)) == 1
+        assert len(fleet.load(self.directory.name)['sn']) == 31
+
+
+class Test_FakeTarallo:
+    """Verify TaralloInterface against the local FakeTarallo in scenarios that are hard to set up on a real one"""
+
+    def setup_method(self, method):
+        self.fake = FakeTarallo()
+        self.tarallo_interface = TaralloInterface(Tarallo(self.fake.start(), self.fake.token), backoff=0.01)
+        self.disk = {
+            'brand': 'PYTHON_TEST',
+            'capacity-decibyte': 500000000000,
+            'hdd-form-factor': '3.5',
+            'model': 'TEST',
+            'sata-ports-n': 1,
+            'smart-data': SMART.working.value,
+            'sn': 'FAKE123456',
+            'type': 'hdd',
+            'working': 'yes',
+        }
+
+    def teardown_method(self, method):
+        self.fake.stop()
+
+    def test_connect_failure(self):
+        tarallo = TaralloInterface(backoff=0.01)
+        # Missing http://
+        assert tarallo.connect(self.fake.url.split('://')[1], self.fake.token) is False
+        assert tarallo.instance is None and tarallo._sessions_open == 0
+        assert tarallo.connect(self.fake.url, 'wrong token') is False
+        # The failed sessions are gone, trying again works
+        assert tarallo.connect(self.fake.url, self.fake.token) is True
+        assert tarallo._sessions.qsize() == 1
+
+    def test_multiple_duplicates(self):
+        self.fake.add_item(self.disk)
+        self.fake.add_item(self.disk)
+        assert self.tarallo_interface.check_duplicate(self.disk) == -1
+        assert self.tarallo_interface.add_disk(self.disk) is False
+        assert len(self.fake.codes_by_feature('sn', self.disk['sn'])) == 2
+
+    def test_update_disk(self):
+        remote = dict(self.disk)
+        del remote['hdd-form-factor']
+        code = self.fake.add_item(remote)
+
+        # Missing and volatile features are updated, the others are left alone
+        wiped = dict(self.disk, working='maybe', notes='Surface scan')
+        assert self.tarallo_interface.add_disk(wiped) is True
+        features = self.fake.items[code]['features']
+        assert features['hdd-form-factor'] == '3.5'
+        assert features['working'] == 'maybe'
+        assert features['notes'] == 'Surface scan'
+        assert len(self.fake.codes_by_feature('sn', self.disk['sn'])) == 1
+
+    def test_retry(self):
+        self.fake.fail_next = 2
+        assert self.tarallo_interface.check_duplicate(self.disk) == 0
+        stats = self.tarallo_interface.stats['get_codes_by_feature']
+        assert stats['calls'] == 3
+        assert stats['retries'] == 2
+        assert stats['errors'] == 2
+
+    def test_insertion_not_retried(self):
+        # The server may have saved the item before failing, a retry could add a duplicate
+        self.fake.failure_rate = 1
+        try:
+            self.tarallo_interface._call('add_item', Item(), idempotent=False)
+        except ServerError:
+            pass
+        else:
+            raise AssertionError("Injected failure not raised")
+        assert self.fake.requests['POST'] == 1
+
+    def test_server_error(self):
+        self.fake.fail_next = self.tarallo_interface.retries + 1
+        try:
+            self.tarallo_interface.check_duplicate(self.disk)
+        except ServerError:
+            pass
+        else:
+            raise AssertionError("Injected failure not raised")
+        assert self.tarallo_interface.check_duplicate(self.disk) == 0
+
+    def test_requests_per_disk(self):
+        self.fake.latency = 0.01
+        self.tarallo_interface.add_disk(self.disk)
+        # duplicate check, insertion and code lookup
+        assert sum(self.fake.requests.values()) == 3
+
+    def test_concurrent_disks(self):
+        import time
+        self.fake.latency = 0.05
+        disks = [dict(self.disk, sn=f'FAKE{i:06d}') for i in range(8)]
+        start = time.perf_counter()
+        assert self.tarallo_interface.add_disks(disks) == [True] * 8
+        elapsed = time.perf_counter() - start
+        # 3 requests per disk, all the disks at once: about as long as a single one
+        assert elapsed < 3 * 0.05 * 4, f"Registration took {elapsed:.2f} s, it's not concurrent"
+        for disk in disks:
+            assert len(self.fake.codes_by_feature('sn', disk['sn'])) == 1
+
+
+class FakeTask(turbofresa.Task):
+    """Task that sends a canned result instead of wiping a disk"""
+
+    def start(self):
+        if self.disk['mount_point'] == 'sdnofork':
+            raise BlockingIOError("Resource temporarily unavailable")
+        super().start()
+
+    def run(self):
+        if self.disk['mount_point'] == 'crash':
+            raise RuntimeError("Crashed on purpose")
+        self.report('progress', badblocks_pass=0, percentage=50)
+        features = dict(self.disk['features'], working='maybe')
+        self.report('result', success=True, features=features, status={'elapsed-seconds': 1})
+
+
+class Test_Results:
+    """Verify that the outcome of the tasks reaches the parent process"""
+
+    def test_progress_events(self):
+        import queue
+        results = queue.Queue()
+        task = turbofresa.Task({'mount_point': 'sdz', 'features': {}}, results)
+        # Runnable outside of turbofresa's main, with the defaults of the command line
+        assert task.max_temperature == thermal.MAX_TEMPERATURE and task.metadata_first is False
+        for fraction in [0, 0.001, 0.5, 0.509, 1, 0, 0.5]:
+            task.report_progress(fraction)
+        events = []
+        while not results.empty():
+            events.append(results.get())
+        assert [(e['badblocks_pass'], e['percentage']) for e in events] == [(0, 0), (0, 50), (0, 100), (1, 0), (1, 50)]
+        assert all(e['mount_point'] == 'sdz' and e['event'] == 'progress' for e in events)
+
+    def test_collect_results(self):
+        from multiprocessing import Queue
+        disk = {'brand': 'PYTHON_TEST', 'model': 'TEST', 'sn': 'RESULT123', 'type': 'ssd', 'working': 'yes'}
+        results = Queue()
+        tasks = [FakeTask({'mount_point': 'sdy', 'features': disk, 'attributes': {5: 0}}, results),
+                 FakeTask({'mount_point': 'crash', 'features': dict(disk, sn='CRASH123')}, results)]
+        history = []
+
+        with FakeTarallo() as fake:
+            code = fake.add_item(disk)
+            turbofresa.tarallo_instance = TaralloInterface(Tarallo(fake.url, fake.token))
+            turbofresa.quiet = True
+            try:
+                for t in tasks:
+                    t.start()
+                outcomes = turbofresa.collect_results(tasks, results, history=history)
+                for t in tasks:
+                    t.join()
+            finally:
+                turbofresa.tarallo_instance = None
+
+            # Only the parent talks to TARALLO, with the features changed by the child
+            assert fake.items[code]['features']['working'] == 'maybe'
+
+        outcomes = {o['mount_point']: o for o in outcomes}
+        assert outcomes['sdy']['success'] is True
+        assert outcomes['sdy']['status']['elapsed-seconds'] == 1
+        assert outcomes['crash']['success'] is False
+        history = {row['sn']: row for row in history}
+        assert history['RESULT123']['success'] is True
+        assert history['RESULT123']['working'] == 'maybe'
+        assert history['RESULT123']['attributes'] == {5: 0}
+        assert history['CRASH123']['success'] is False
+
+
+    def test_report_failure(self):
+        from multiprocessing import Queue
+        import requests
+
+        class Unreachable:
+            def add_disk(self, features):
+                raise requests.ConnectionError("Network is unreachable")
+
+        disk = {'brand': 'PYTHON_TEST', 'model': 'TEST', 'sn': 'OFFLINE1', 'type': 'ssd', 'working': 'yes'}
+        results = Queue()
+        tasks = [FakeTask({'mount_point': 'sdw', 'features': disk}, results),
+                 FakeTask({'mount_point': 'sdx', 'features': dict(disk, sn='OFFLINE2')}, results)]
+        turbofresa.tarallo_instance = Unreachable()
+        turbofresa.quiet = True
+        try:
+            for t in tasks:
+                t.start()
+            outcomes = turbofresa.collect_results(tasks, results)
+            for t in tasks:
+                t.join()
+        finally:
+            turbofresa.tarallo_instance = None
+
+        # Every disk is still collected
+        assert sorted(o['mount_point'] for o in outcomes) == ['sdw', 'sdx']
+        assert all(o['success'] is True and o['reported'] is False for o in outcomes)
+        assert run_status.describe({'state': 'done', 'working': 'maybe', 'reported': False}) == \
+            'done, working: maybe, NOT in T.A.R.A.L.L.O.'
+
+
+class Test_Pipeline:
+    """Verify that each disk goes through the pipeline without waiting for the others"""
+
+    def setup_method(self, method):
+        self.fake = FakeTarallo()
+        self.fake.start()
+        self.parse_disk = smartctl_parser.parse_disk
+        self.task = turbofresa.Task
+        smartctl_parser.parse_disk = self.fake_parse_disk
+        turbofresa.Task = FakeTask
+        turbofresa.tarallo_instance = TaralloInterface(Tarallo(self.fake.url, self.fake.token))
+        turbofresa.quiet = True
+        turbofresa.simulate = False
+        self.waited = None
+
+    def teardown_method(self, method):
+        smartctl_parser.parse_disk = self.parse_disk
+        turbofresa.Task = self.task
+        turbofresa.tarallo_instance = None
+        self.fake.stop()
+
+    def fake_parse_disk(self, device, cache, interactive=False, usbdebug=False):
+        import time
+        if device['name'] == 'sdslow':
+            # Only continue once the fast disk has been wiped and reported
+            start = time.monotonic()
+            while time.monotonic() - start < 10:
+                codes = self.fake.codes_by_feature('sn', 'FAST1')
+                if codes and self.fake.items[codes[0]]['features'].get('working') == 'maybe':
+                    self.waited = True
+                    break
+                time.sleep(0.05)
+            else:
+                self.waited = False
+        if device['name'] == 'sdusb':
+            return None
+        disk = smartctl_parser.dummy_disk(smartctl_parser.Disk())
+        disk.serial_number = device['serial']
+        disk.dev = device['name']
+        return disk
+
+    def test_pipeline(self):
+        from multiprocessing import Queue
+        results = Queue()
+        devices = [{'name': 'sdslow', 'serial': 'SLOW1'}, {'name': 'sdfast', 'serial': 'FAST1'},
+                   {'name': 'sdusb', 'serial': 'USB1'}, {'name': 'sdnofork', 'serial': 'NOFORK1'}]
+        pipeline = turbofresa.Pipeline(results, parse_workers=2, cache_ttl=0)
+        pipeline.start(devices)
+        outcomes = turbofresa.collect_results(pipeline.tasks, results, pipeline.done)
+
+        assert self.waited is True
+        assert sorted(o['mount_point'] for o in outcomes) == ['sdfast', 'sdslow']
+        assert all(o['success'] for o in outcomes)
+        # Couldn't be started, it's not waited for
+        assert [t.disk['mount_point'] for t in pipeline.tasks if t.disk['mount_point'] == 'sdnofork'] == []
+        assert len(self.fake.codes_by_feature('sn', 'SLOW1')) == 1
+        assert len(self.fake.codes_by_feature('sn', 'USB1')) == 0
+
+
+class Test_Aggregator:
+    """Verify that the stations reach the aggregator and that the statistics add up"""
+
+    def setup_method(self, method):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+
+    def teardown_method(self, method):
+        self.directory.cleanup()
+
+    def run_status(self, name: str) -> run_status.RunStatus:
+        return run_status.RunStatus(os.path.join(self.directory.name, name, 'status.json'))
+
+    def test_rolling_stats(self):
+        aggregator = Aggregator(window=3600)
+        now = aggregator.started
+        first = self.run_status('first')
+        first.update('sda', state='wiping', sn='AGG1', capacity=10 * 1000**3, badblocks_pass=0, percentage=0)
+        first.update('sdb', state='wiping', sn='AGG2', capacity=10 * 1000**3, badblocks_pass=0, percentage=0)
+        aggregator.receive('first', {'bays': 4, 'run': first.snapshot()}, now)
+
+        # Half an hour later: sda is done (20 GB written and read back), sdb failed halfway through writing
+        first.update('sda', state='done', working='yes')
+        first.update('sdb', state='failed', badblocks_pass=0, percentage=50)
+        aggregator.receive('first', {'bays': 4, 'run': first.snapshot()}, now + 1800)
+        second = self.run_status('second')
+        second.update('sda', state='paused', sn='AGG3', capacity=10 * 1000**3, temperature=58)
+        aggregator.receive('second', {'bays': None, 'run': second.snapshot()}, now + 1800)
+        # Same update again, nothing changes
+        aggregator.receive('first', {'bays': 4, 'run': first.snapshot()}, now + 3600)
+
+        summary = aggregator.summary(now + 3600)
+        assert summary['gb-per-hour'] == 25
+        assert summary['finished'] == 2
+        assert summary['failures'] == 1
+        assert summary['busy'] == 1
+        assert summary['stations']['first']['free'] == 4
+        assert summary['stations']['second']['free'] is None
+        assert summary['stations']['second']['online'] is False
+
+        # Old enough to be out of the window, but still in the totals
+        summary = aggregator.summary(now + 2 * 3600)
+        assert summary['gb-per-hour'] == 0
+        assert summary['finished'] == 0
+        assert summary['finished-total'] == 2
+
+    def test_restart(self):
+        run = self.run_status('restarted')
+        run.update('sda', state='done', sn='AGG4', capacity=10 * 1000**3, working='yes')
+        run.update('sdb', state='wiping', sn='AGG5', capacity=10 * 1000**3, badblocks_pass=1, percentage=0)
+        # Started after the run, when sda was already done
+        aggregator = Aggregator(window=3600)
+        now = aggregator.started
+        aggregator.receive('restarted', {'bays': 2, 'run': run.snapshot()}, now)
+        run.update('sdb', percentage=50)
+        aggregator.receive('restarted', {'bays': 2, 'run': run.snapshot()}, now + 1800)
+        summary = aggregator.summary(now + 3600)
+        # Only the reading pass of sdb from 0% to 50% happened here
+        assert summary['gb-per-hour'] == 5
+        assert summary['finished'] == 0
+
+    def test_forget_disks(self):
+        aggregator = Aggregator(window=3600)
+        now = aggregator.started
+        first = self.run_status('forget')
+        first.update('sda', state='wiping', sn='AGG6', capacity=10 * 1000**3, badblocks_pass=0, percentage=10)
+        aggregator.receive('forget', {'bays': 2, 'run': first.snapshot()}, now)
+        first.update('sda', state='done', working='yes')
+        aggregator.receive('forget', {'bays': 2, 'run': first.snapshot()}, now + 60)
+        assert len(aggregator._disks) == 1
+
+        # The next run on the same station replaces the old one
+        second = self.run_status('forget-again')
+        second.state['started'] = first.state['started'] + 1
+        second.update('sda', state='wiping', sn='AGG7', capacity=10 * 1000**3, badblocks_pass=0, percentage=0)
+        aggregator.receive('forget', {'bays': 2, 'run': second.snapshot()}, now + 120)
+        assert list(aggregator._disks) == [('forget', second.state['started'], 'sda')]
+        assert aggregator.summary(now + 120)['finished'] == 1
+
+        # A station that went away is forgotten after a window
+        aggregator.summary(now + 120 + 3601)
+        assert len(aggregator._disks) == 0
+
+    def test_agent(self):
+        import json
+        import urllib.request
+        run = self.run_status('station')
+        run.update('sdc', state='wiping', sn='AGENT1', capacity=1000**3, badblocks_pass=1, percentage=10)
+        with Aggregator() as aggregator:
+            agent = Agent(aggregator.url, run, station='bay 1', bays=2, interval=0.05)
+            agent.start()
+            run.update('sdc', percentage=20)
+            agent.stop()
+            with urllib.request.urlopen(aggregator.url + '/summary') as response:
+                summary = json.loads(response.read())
+            with urllib.request.urlopen(aggregator.url) as response:
+                text = response.read().decode()
+
+        station = summary['stations']['bay 1']
+        assert station['online'] is True
+        assert station['busy'] == 1 and station['free'] == 1
+        assert station['disks']['sdc']['percentage'] == 20
+        assert 'AGENT1' in text and 'reading and comparing 20%' in text
+
+    def test_invalid_update(self):
+        import json
+        import urllib.error
+        import urllib.request
+        with Aggregator() as aggregator:
+            for body in [{'run': {}}, {'run': {'started': 1, 'finished': None}}, {'bays': 'two', 'run': {}},
+                         {'run': {'started': 1, 'finished': None, 'disks': {'sda': 'wiping'}}}]:
+                request = urllib.request.Request(aggregator.url + '/stations/broken', data=json.dumps(body).encode(),
+                                                 method='POST', headers={'Content-Type': 'application/json'})
+                try:
+                    urllib.request.urlopen(request)
+                except urllib.error.HTTPError as e:
+                    assert e.code == 400
+                else:
+                    assert False, f"{body} accepted"
+            assert aggregator.summary()['stations'] == {}
+
+    def test_unreachable(self):
+        with Aggregator() as aggregator:
+            url = aggregator.url
+        # The wipe goes on anyway
+        agent = Agent(url, self.run_status('alone'), station='alone', interval=0.05)
+        assert agent.push() is False
+        assert agent.failures == 1
+
+
+class Test_Startup:
+    """Verify that commands not touching the disks start fast"""
+
+    def test_lazy_imports(self):
+        code = "import sys, turbofresa; print(','.join(m for m in sys.modules))"
+        output = sp.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                        stdout=sp.PIPE, check=True).stdout.decode()
+        loaded = output.strip().split(',')
+        for module in benchmarks.LAZY_MODULES:
+            assert module not in loaded, f"{module} is imported at startup"
+
+    def test_startup_budget(self):
+        for command, overhead in benchmarks.startup_overhead(runs=3).items():
+            assert overhead < benchmarks.STARTUP_BUDGET, \
+                f"turbofresa {command} took {overhead * 1000:.0f} ms, budget {benchmarks.STARTUP_BUDGET * 1000:.0f} ms"
+
+    def test_status(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'smartctl', 'status.json')
+            status = run_status.RunStatus(path)
+            status.update('sda', state='wiping', sn='STATUS1', badblocks_pass=1, percentage=42)
+            status.update('sdb', state='paused', sn='STATUS2', temperature=57)
+            status.update('sdc', state='wiping', sn='STATUS3', **{'metadata-destroyed': False})
+            state = run_status.read(path)
+            assert run_status.is_running(state)
+            text = run_status.format_status(state)
+            assert 'STATUS1' in text and 'reading and comparing 42%' in text
+            assert 'paused, 57 °C' in text
+            assert 'wiping, metadata NOT destroyed' in text
+
+            status.update('sda', state='done', working='yes')
+            status.finish()
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'turbofresa.py')
+            output = sp.run([sys.executable, script, 'status'], cwd=directory, stdout=sp.PIPE, check=True).stdout.decode()
+            assert output.startswith('Finished')
+            assert 'done, working: yes' in output
+        assert run_status.read(path) is None
+
+
 class Test_Turbofresa:
     """Verify functioning of disk parser and TURBOFRESA"""
 
@@ -174,3 +1010,61 @@ class Test_Turbofresa:
         assert len(ignored) > 0
         for disk in ignored:
             assert "sd" in disk
+
+
+class Test_SurfaceScan:
+    """Verify the per-region timings of the surface scan"""
+
+    def test_progress(self):
+        import io
+        # badblocks rewrites the progress line with backspaces
+        status = '{:6.2f}% done, 0:01 elapsed. (0/0/0 errors)'
+        output = 'Checking for bad blocks in read-write mode\nFrom block 0 to 999\nTesting with pattern 0x00: '
+        for percent in [0, 12.5, 50]:
+            line = status.format(percent)
+            output += line + '\b' * len(line)
+        output += '\nReading and comparing: ' + status.format(100)
+
+        r, w = os.pipe()
+        os.write(w, output.encode())
+        os.close(w)
+        with io.open(r, 'rb') as stream:
+            progress = list(surface_scan.read_progress(stream))
+        assert progress == [0, 0.125, 0.5, 1]
+
+    def test_unknown_capacity(self):
+        assert smartctl_parser.capacity({'capacity-byte': 240057409536}) == 240057409536
+        assert smartctl_parser.capacity({'capacity-decibyte': 500000000000}) == 500000000000
+        assert smartctl_parser.capacity({'capacity-decibyte': -1}) is None
+        assert smartctl_parser.capacity({}) is None
+        heatmap = surface_scan.Heatmap(None)
+        heatmap.record(0, 0)
+        heatmap.record(0.5, 10)
+        assert heatmap.median_throughput() is None
+        assert heatmap.slow_regions() == []
+        assert heatmap.summary() == "Surface scan: no timing information"
+
+    def test_slow_regions(self):
+        gib = 1024**3
+        heatmap = surface_scan.Heatmap(10 * gib, region_size=gib)
+        assert len(heatmap.seconds) == 10
+
+        # Two passes at constant speed, except for region 7 which stalls for a while
+        for _ in range(2):
+            t = 0
+            for i in range(11):
+                if i == 8:
+                    heatmap.record(7.5 / 10, t + 5)
+                    t += 60
+                heatmap.record(i / 10, t)
+                t += 10
+
+        assert heatmap.slow_regions() == [7]
+        assert 'Slow regions' in heatmap.summary()
+
+    def test_no_slow_regions(self):
+        heatmap = surface_scan.Heatmap(1000, region_size=100)
+        for i in range(101):
+            heatmap.record(i / 100, i)
+        assert heatmap.slow_regions() == []
+        assert 'Slow regions' not in heatmap.summary()
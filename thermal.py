@@ -0,0 +1,107 @@
+"""
+Temperature monitoring of the disks being wiped
+Many disks at full load in a passively cooled case get too hot, start throwing errors and
+get marked as failed. badblocks is paused (SIGSTOP) when a disk gets too hot and resumed
+(SIGCONT) when it cools down.
+"""
+
+import os
+import re
+import signal
+import subprocess as sp
+import sys
+
+import smartctl_parser
+
+MAX_TEMPERATURE = 55  # °C, can be changed with --max-temp
+HYSTERESIS = 5  # °C below the maximum before resuming
+POLL_INTERVAL = 30  # seconds between readings
+
+# SCSI: "Current Drive Temperature:     33 C", NVMe: "Temperature:                        35 Celsius"
+CURRENT = re.compile(r'^(?:Current Drive )?Temperature:\s+(\d+) C', re.MULTILINE)
+
+
+def parse_temperature(smartctl_output: str):
+    """
+    :param smartctl_output: output of smartctl -A (or -x)
+    :return: temperature in °C, None if not reported
+    """
+    # 194 is the actual temperature, 190 is the airflow temperature: prefer 194 if both are there
+    attributes = smartctl_parser.parse_attributes(smartctl_output)
+    for attribute in (194, 190):
+        if attribute in attributes:
+            return attributes[attribute]
+
+    match = CURRENT.search(smartctl_output)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def read_temperature(mount_point: str):
+    """
+    :param mount_point: name of the disk (e.g. sda)
+    :return: current temperature of the disk in °C, None if not available
+    """
+    result = sp.run(['sudo', '-n', 'smartctl', '-d', 'sat,auto', '-T', 'verypermissive', '-A',
+                     os.path.join('/dev', mount_point)], stdout=sp.PIPE, stderr=sp.DEVNULL)
+    return parse_temperature(result.stdout.decode(sys.stdout.encoding, errors='replace'))
+
+
+def signal_group(p: sp.Popen, sig: int):
+    """
+    Sends a signal to sudo and badblocks, p must be the leader of its process group (preexec_fn=os.setpgrp)
+    """
+    sp.run(['sudo', '-n', 'kill', '-' + str(int(sig)), '--', '-' + str(p.pid)])
+
+
+class Throttle:
+    """
+    Decides when to pause and resume a disk and keeps track of the temperatures
+    """
+    def __init__(self, max_temperature: int = MAX_TEMPERATURE, hysteresis: int = HYSTERESIS):
+        self.max_temperature = max_temperature
+        self.resume_temperature = max_temperature - hysteresis
+        self.peak = None
+        self.paused_since = None
+        self.throttled = 0.0  # seconds spent paused, excluding the current pause
+
+    @property
+    def paused(self) -> bool:
+        return self.paused_since is not None
+
+    def throttled_seconds(self, now: float) -> float:
+        if self.paused:
+            return self.throttled + now - self.paused_since
+        return self.throttled
+
+    def update(self, temperature, now: float):
+        """
+        :param temperature: last reading in °C, None if it couldn't be read
+        :param now: time of the reading in seconds
+        :return: 'pause' or 'resume' if the disk has to be paused or resumed, None otherwise
+        """
+        if temperature is not None and (self.peak is None or temperature > self.peak):
+            self.peak = temperature
+
+        if not self.paused and temperature is not None and temperature >= self.max_temperature:
+            self.paused_since = now
+            return 'pause'
+        # Don't keep a disk paused forever if its temperature can't be read anymore
+        if self.paused and (temperature is None or temperature <= self.resume_temperature):
+            self.throttled += now - self.paused_since
+            self.paused_since = None
+            return 'resume'
+        return None
+
+    def pause(self, p: sp.Popen):
+        signal_group(p, signal.SIGSTOP)
+
+    def resume(self, p: sp.Popen):
+        signal_group(p, signal.SIGCONT)
+
+    def summary(self) -> str:
+        if self.peak is None:
+            return "Temperature: not available"
+        return f"Peak temperature: {self.peak} °C, throttled for {self.throttled / 60:.0f} min " \
+               f"(limit {self.max_temperature} °C)"
@@ -22,14 +22,23 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+# Only what every command needs is imported here, to start in milliseconds even on a slow station:
+# the T.A.R.A.L.L.O. client (requests alone takes ~100 ms) and dotenv are imported when used
 import os, sys
-import logging  # TODO: Add log messages
-from tarallo_interface import TaralloInterface
-from multiprocessing import Process
+import json
+from multiprocessing import Process, Queue
+import queue
+import threading
 import subprocess as sp
 import argparse
 import smartctl_parser
-from dotenv import load_dotenv
+import surface_scan
+import thermal
+import metadata_wipe
+import backfill
+import fleet
+import run_status
+import time
 
 __version__ = '1.3'
 
@@ -38,13 +47,23 @@ quiet = None
 simulate = None
 can_connect = None
 tarallo_instance = None
+current_run = None  # run_status.RunStatus, shown by "turbofresa status"
 
+PARSE_WORKERS = 4  # smartctl runs at once, can be changed with --parse-workers
 
-def ask_confirm(disks: list):
+
+def ask_confirm(devices: list):
+    """
+    Asks once for the whole batch, before any disk is parsed
+    :param devices: devices from smartctl_parser.list_devices
+    """
     print("\nThe following disks are going to be wiped:")
 
-    for d in disks:
-        print("- /dev/" + d['mount_point'])
+    for d in devices:
+        if d['serial']:
+            print("- /dev/" + d['name'] + " (" + d['serial'] + ")")
+        else:
+            print("- /dev/" + d['name'])
 
     while True:
         user_response = input("\nAre you 100% sure of what you're about to do? [N/y] ")
@@ -56,6 +75,31 @@ def ask_confirm(disks: list):
             print("Unrecognized response... Asking again nicely.")
 
 
+def connect_tarallo():
+    """
+    Connects to the T.A.R.A.L.L.O. instance configured in .env
+    :return: TaralloInterface, None if the connection failed
+    """
+    if not quiet:
+        print('\n\n===> Connecting to T.A.R.A.L.L.O. database')
+    from dotenv import load_dotenv
+    from tarallo_interface import TaralloInterface
+
+    load_dotenv()
+    tarallo = TaralloInterface()
+    if not tarallo.connect(os.getenv("TARALLO_URL"), os.getenv("TARALLO_TOKEN")):
+        return None
+    return tarallo
+
+
+def set_status(mount_point: str, **fields):
+    """
+    Updates the state of a disk in the status file, if there's one
+    """
+    if current_run is not None:
+        current_run.update(mount_point, **fields)
+
+
 def ignore_sys_disks() -> list:
     """
     Checks which disks have system partitions in them and asks if the user wishes to add
@@ -109,13 +153,60 @@ def ignore_user_disks() -> list:
 class Task(Process):
     """
     Disk cleaning process
+    Changes made here are lost when the process ends, so everything the parent needs to know
+    (progress, milestones and the final outcome) is sent as an event through the results queue.
+    It's forked from a Pipeline thread while other threads are running: a lock held by one of them
+    would stay locked forever here. That's why tasks don't print, don't call set_status and don't
+    touch the cache or T.A.R.A.L.L.O., the results queue is the only thing shared with the parent
+    and multiprocessing sets up its locks again after the fork.
     """
-    def __init__(self, disk):
+    def __init__(self, disk, results: Queue = None, max_temperature: int = thermal.MAX_TEMPERATURE,
+                 metadata_first: bool = False):
         """
         :param disk: Disk object
+        :param results: queue where events are sent to the parent, see collect_results
+        :param max_temperature: pause badblocks while the disk is hotter than this (°C)
+        :param metadata_first: destroy partition tables and superblocks before badblocks starts
         """
         super().__init__()
         self.disk = disk
+        self.results = results
+        self.max_temperature = max_temperature
+        self.metadata_first = metadata_first
+        self._progress = (0, -1)  # (badblocks pass, last percentage reported)
+
+    def report(self, event: str, **data):
+        """
+        Sends an event to the parent process
+        """
+        if self.results is not None:
+            self.results.put(dict(data, event=event, mount_point=self.disk['mount_point']))
+
+    def report_progress(self, fraction: float):
+        """
+        Called by the badblocks reader for each progress update, sends one event per percent
+        """
+        badblocks_pass, last = self._progress
+        percentage = int(fraction * 100)
+        if percentage < last:
+            # Writing is done, now reading and comparing from the start
+            badblocks_pass += 1
+        if percentage != last:
+            self._progress = (badblocks_pass, percentage)
+            self.report('progress', badblocks_pass=badblocks_pass, percentage=percentage)
+
+    def destroy_metadata(self, status: dict):
+        """
+        Overwrites partition tables and superblocks, reporting how it went
+        Never raises: whatever happens, the full wipe must start afterwards.
+        :param status: status record of the task, updated with the outcome
+        """
+        try:
+            status['metadata-destroyed'] = metadata_wipe.destroy_metadata(self.disk['mount_point'])
+            self.report('metadata-destroyed', success=status['metadata-destroyed'])
+        except Exception as e:
+            status['metadata-destroyed'] = False
+            self.report('metadata-destroyed', success=False, error=str(e))
 
     def run(self):
         """
@@ -125,18 +216,28 @@ class Task(Process):
         Bad blocks are eventually written in a txt file named as HDDXXX or sdX in case of failures
         while retrieving the HDD code from T.A.R.A.L.L.O.
         If this file is empty, then the disk is good to go, otherwise it'll be kept
-        and the broken hard drive is reported into the log file and informations
-        are written to the T.A.R.A.L.L.O. database.
+        and the broken hard drive is reported into the log file.
+        The updated features are sent to the parent, which writes them to the T.A.R.A.L.L.O. database.
+        The time spent on each region of the disk is recorded too: disks that pass but have
+        abnormally slow regions are marked as "maybe" working.
+        badblocks is paused while the disk is hotter than max_temperature.
+        With metadata_first, partition tables and filesystem superblocks are zeroed before badblocks starts.
+        sudo is always called with -n here: the password is asked when the disks are parsed, and if it's
+        needed again nobody could type it. The prompt would end up in the stderr pipe, and reading the
+        terminal from the process group of badblocks would stop it with SIGTTIN. Failing right away is better.
         """
 
         global tarallo_instance
 
+        start = time.monotonic()
+        features = self.disk['features']
         if tarallo_instance is not None:
             code = self.disk['code'][0]
             filename = 'badblocks_error_logs/' + code + '.txt'
         else:
-            filename = 'badblocks_error_logs/' + disk['sn'] + '.txt'
+            filename = 'badblocks_error_logs/' + features['sn'] + '.txt'
         mount_point = self.disk['mount_point']
+        capacity = smartctl_parser.capacity(features)
 
         # Unmounting disk
         output = sp.check_output(["lsblk", "-ln", "-o", "NAME,MOUNTPOINT"]).decode(sys.stdout.encoding)
@@ -144,43 +245,304 @@ class Task(Process):
             if line.startswith(mount_point):
                 line = line.split()
                 if len(line) > 1:
-                    sp.run(["sudo", "umount", os.path.join("/dev", line[0])])
+                    sp.run(["sudo", "-n", "umount", os.path.join("/dev", line[0])])
+
+        status = self.disk['status'] = {}
+
+        # Making the data unreadable in seconds, the full pass below is what actually guarantees the wipe
+        if self.metadata_first:
+            self.destroy_metadata(status)
 
         # Cleaning disk
-        with sp.Popen(['sudo', '-S', 'badblocks', '-s', '-w', '-t', '0x00', '-o', filename, os.path.join("/dev", mount_point)]) as p:
+        # Progress is read from stderr to time each region of the disk
+        # badblocks gets its own process group, to be paused and resumed along with sudo. preexec_fn is
+        # safe here, the task has no other threads yet
+        heatmap = surface_scan.Heatmap(capacity)
+        throttle = thermal.Throttle(self.max_temperature)
+        with sp.Popen(['sudo', '-n', 'badblocks', '-s', '-w', '-t', '0x00', '-o', filename, os.path.join("/dev", mount_point)],
+                      stderr=sp.PIPE, preexec_fn=os.setpgrp) as p:
+            reader = threading.Thread(target=surface_scan.follow, args=(p.stderr, heatmap, self.report_progress),
+                                      daemon=True)
+            reader.start()
             success = False
             try:
-                disk_gb = self.disk['features']['capacity-byte'] / 1024**3
-                mins_per_gb = 2  # TODO: could be set with a config file?
-                timeout = 60 * mins_per_gb * disk_gb
-                p.wait(timeout=timeout)
+                if capacity is not None:
+                    disk_gb = capacity / 1024**3
+                    mins_per_gb = 2  # TODO: could be set with a config file?
+                    timeout = 60 * mins_per_gb * disk_gb
+                else:
+                    # No idea how long it should take
+                    timeout = float('inf')
+                # Time spent paused doesn't count towards the timeout
+                deadline = time.monotonic() + timeout
+                while True:
+                    try:
+                        p.wait(timeout=thermal.POLL_INTERVAL)
+                        break
+                    except sp.TimeoutExpired:
+                        now = time.monotonic()
+                        if now > deadline + throttle.throttled_seconds(now):
+                            raise
+                        action = throttle.update(thermal.read_temperature(mount_point), now)
+                        if action == 'pause':
+                            throttle.pause(p)
+                            heatmap.pause(now)
+                            self.report('paused', temperature=throttle.peak)
+                        elif action == 'resume':
+                            throttle.resume(p)
+                            heatmap.resume(now)
+                            self.report('resumed')
                 if p.returncode == 0:
                     success = True
 
-                global quiet
-                if not quiet:
-                    print("Ended cleaning " + os.path.join("/dev/", mount_point))
-
             except sp.TimeoutExpired:
                 success = False
+                if throttle.paused:
+                    throttle.resume(p)
                 p.kill()
             finally:
-                features = self.disk['features']
+                reader.join(timeout=5)
+                throttle.update(None, time.monotonic())
+                status['peak-temperature'] = throttle.peak
+                status['throttled-seconds'] = round(throttle.throttled)
+                status['throughput'] = heatmap.median_throughput()
+                status['slow-regions'] = len(heatmap.slow_regions())
                 if success is True:
                     os.remove(filename)
                     features['data-erased'] = 'yes'
                     features['surface-scan'] = 'pass'
-                    features['smart-data'] = smartctl_parser.SMART.working
+                    features['smart-data'] = smartctl_parser.SMART.working.value
+                    # Passed, but some regions needed way more time than the others: it may be dying
+                    if status['slow-regions'] > 0:
+                        features['working'] = 'maybe'
                 else:
-                    features['smart-data'] = smartctl_parser.SMART.fail
+                    features['smart-data'] = smartctl_parser.SMART.fail.value
                     features['working'] = 'maybe'
 
-                if tarallo_instance is not None:
-                    tarallo_instance.add_disk(features)
+                # Raw timings go next to the smartctl output, the summary goes to the notes
+                heatmap.save(os.path.join('smartctl', features['sn'] + '.heatmap'))
+                summary = heatmap.summary() + '\n' + throttle.summary()
+                if not success and os.path.exists(filename):
+                    summary += '\n' + surface_scan.bad_blocks_summary(filename, heatmap if capacity else None)
+                if 'notes' in features:
+                    features['notes'] += '\n\n' + summary
+                else:
+                    features['notes'] = summary
+
+                status['elapsed-seconds'] = round(time.monotonic() - start)
+                self.report('result', success=success, features=features, status=status)
 
                 return success
 
 
+class Pipeline:
+    """
+    Moves each disk on its own through parse -> register -> wipe, the report is done by collect_results.
+    The first disk ready starts being wiped while the others are still being parsed or registered,
+    instead of waiting for every disk to go through each stage.
+    """
+    def __init__(self, results: Queue, parse_workers: int = PARSE_WORKERS, wipe_workers: int = 0,
+                 usbdebug: bool = False, cache_ttl: int = smartctl_parser.CACHE_TTL,
+                 max_temperature: int = thermal.MAX_TEMPERATURE, metadata_first: bool = False):
+        """
+        :param results: queue for the events of the tasks
+        :param parse_workers: maximum number of disks parsed at once
+        :param wipe_workers: maximum number of disks wiped at once, 0 for no limit
+        :param usbdebug: allow scan of USB drives (DEBUG ONLY!!!)
+        :param cache_ttl: see smartctl_parser.parse_disks
+        :param max_temperature: see Task
+        :param metadata_first: see Task
+        """
+        self.results = results
+        self.parse_slots = threading.BoundedSemaphore(parse_workers)
+        self.wipe_slots = threading.BoundedSemaphore(wipe_workers) if wipe_workers > 0 else None
+        self.usbdebug = usbdebug
+        self.max_temperature = max_temperature
+        self.metadata_first = metadata_first
+        self.cache = smartctl_parser.SmartCache(os.path.join(smartctl_parser.smartctl_dir(), "cache.json"), cache_ttl)
+        self.disks = []  # disks that made it past registration
+        self.tasks = []  # tasks of the disks being wiped, added right before starting them
+        self.done = threading.Event()  # set when every disk has been wiped or dropped
+        self._threads = []
+
+    def start(self, devices: list):
+        """
+        :param devices: devices from smartctl_parser.list_devices
+        """
+        self._threads = [threading.Thread(target=self._flow, args=(d,), daemon=True) for d in devices]
+        for t in self._threads:
+            t.start()
+        threading.Thread(target=self._wait, daemon=True).start()
+
+    def _wait(self):
+        for t in self._threads:
+            t.join()
+        self.cache.save()
+        self.done.set()
+
+    def _flow(self, device: dict):
+        mount_point = device['name']
+        try:
+            set_status(mount_point, state='parsing', sn=device.get('serial') or '')
+            with self.parse_slots:
+                disk = smartctl_parser.parse_disk(device, self.cache, interactive=not quiet, usbdebug=self.usbdebug)
+            if disk is None:
+                set_status(mount_point, state='skipped')
+                return
+            d = smartctl_parser.tarallo_conversion([disk])[0]
+            features = d['features']
+            features['erased'] = None
+            features['surface-scan'] = None
+            set_status(mount_point, sn=features['sn'], capacity=smartctl_parser.capacity(features))
+            # Kept here for the fleet history, the notes are rewritten by the task
+            d['attributes'] = smartctl_parser.parse_attributes(disk.smart_data_long)
+
+            # Adding disks to Tarallo if not present
+            if tarallo_instance is not None:
+                set_status(mount_point, state='registering')
+                if tarallo_instance.add_disk(features) is False:
+                    print(f"Something went wrong with /dev/{mount_point} addition to database, skipping it")
+                    set_status(mount_point, state='skipped')
+                    return
+                d['code'] = tarallo_instance.get_codes('sn', features['sn'])
+            self.disks.append(d)
+
+            if simulate:
+                if not quiet:
+                    print("Started cleaning /dev/" + mount_point)
+                    print("Ended cleaning /dev/" + mount_point)
+                set_status(mount_point, state='done')
+                return
+
+            set_status(mount_point, state='waiting')
+            if self.wipe_slots is not None:
+                self.wipe_slots.acquire()
+            try:
+                set_status(mount_point, state='wiping')
+                task = Task(d, self.results, self.max_temperature, self.metadata_first)
+                if not quiet:
+                    print("Started cleaning /dev/" + mount_point)
+                # Listed first, so collect_results knows the task before any of its events arrive
+                self.tasks.append(task)
+                # Forked from this thread while the others may be holding some lock (the run status,
+                # the cache, stdout...). The task never takes any of them, see Task
+                try:
+                    task.start()
+                except Exception:
+                    # Never started, collect_results would wait for its result forever
+                    self.tasks.remove(task)
+                    raise
+                task.join()
+            finally:
+                if self.wipe_slots is not None:
+                    self.wipe_slots.release()
+        except Exception as e:
+            # Don't let a disk take down the others
+            print(f"Error while processing /dev/{mount_point}: {e!r}")
+            set_status(mount_point, state='error')
+
+
+def collect_results(tasks: list, results: Queue, done: threading.Event = None, history: list = None) -> list:
+    """
+    Receives the events sent by the tasks until all of them are done, printing their progress
+    and reporting their outcome to T.A.R.A.L.L.O., one disk at a time from here
+    :param tasks: tasks, started or about to be, it may keep growing until done is set
+    :param results: queue shared by all the tasks
+    :param done: set when no more tasks will be added, None if tasks is already complete
+    :param history: if set, a fleet history row is appended here for each disk
+    :return: the result event of every task
+    """
+    reported = set()
+    outcomes = []
+    while (done is not None and not done.is_set()) or len(reported) < len(tasks):
+        try:
+            event = results.get(timeout=1)
+        except queue.Empty:
+            # A task that crashed won't ever send its result
+            for t in list(tasks):
+                mount_point = t.disk['mount_point']
+                if mount_point not in reported and not t.is_alive() and t.exitcode not in (None, 0):
+                    print(f"Cleaning /dev/{mount_point} crashed (exit code {t.exitcode})")
+                    outcomes.append({'event': 'result', 'mount_point': mount_point, 'success': False,
+                                     'features': t.disk['features'], 'status': {}})
+                    if history is not None:
+                        history.append(fleet.make_row(t.disk['features'], {}, t.disk.get('attributes', {}), False))
+                    set_status(mount_point, state='crashed')
+                    reported.add(mount_point)
+            continue
+
+        mount_point = event['mount_point']
+        if event['event'] == 'result':
+            if not quiet:
+                print("Ended cleaning /dev/" + mount_point)
+            if tarallo_instance is not None:
+                try:
+                    event['reported'] = tarallo_instance.add_disk(event['features']) is not False
+                except Exception as e:
+                    # Network down or server in trouble: the other disks must still be collected
+                    print(f"Failed to report /dev/{mount_point} to T.A.R.A.L.L.O.: {e!r}")
+                    event['reported'] = False
+                set_status(mount_point, reported=event['reported'])
+            if history is not None:
+                disk = next((t.disk for t in tasks if t.disk['mount_point'] == mount_point), {})
+                history.append(fleet.make_row(event['features'], event['status'], disk.get('attributes', {}),
+                                              event['success']))
+            set_status(mount_point, state='done' if event['success'] else 'failed',
+                       working=event['features'].get('working'))
+            outcomes.append(event)
+            reported.add(mount_point)
+            continue
+
+        if event['event'] == 'progress':
+            set_status(mount_point, state='wiping', badblocks_pass=event['badblocks_pass'],
+                       percentage=event['percentage'])
+        elif event['event'] == 'paused':
+            set_status(mount_point, state='paused', temperature=event['temperature'])
+        elif event['event'] == 'resumed':
+            set_status(mount_point, state='wiping')
+        elif event['event'] == 'metadata-destroyed':
+            set_status(mount_point, **{'metadata-destroyed': event['success']})
+
+        if quiet:
+            continue
+        elif event['event'] == 'progress':
+            if event['percentage'] % 10 == 0:
+                phase = 'writing' if event['badblocks_pass'] == 0 else 'reading and comparing'
+                print(f"/dev/{mount_point}: {phase} {event['percentage']}%")
+        elif event['event'] == 'paused':
+            print(f"Paused cleaning /dev/{mount_point}, temperature {event['temperature']} °C")
+        elif event['event'] == 'resumed':
+            print(f"Resumed cleaning /dev/{mount_point}")
+        elif event['event'] == 'metadata-destroyed':
+            if event['success']:
+                print("Metadata destroyed on /dev/" + mount_point)
+            else:
+                reason = f" ({event['error']})" if 'error' in event else ''
+                print("Failed to destroy some metadata on /dev/" + mount_point + reason + ", continuing with the full wipe")
+
+    return outcomes
+
+
+def print_summary(outcomes: list):
+    print("\n\n===> Summary")
+    for outcome in sorted(outcomes, key=lambda o: o['mount_point']):
+        features = outcome['features']
+        status = outcome['status']
+        result = 'pass' if outcome['success'] else 'FAIL'
+        line = f"/dev/{outcome['mount_point']:<8} {features.get('sn', ''):<20} {result:<5} working: {features.get('working', '?')}"
+        if 'elapsed-seconds' in status:
+            line += f", {status['elapsed-seconds'] / 3600:.1f} h"
+        if status.get('peak-temperature') is not None:
+            line += f", peak {status['peak-temperature']} °C"
+        if status.get('throttled-seconds'):
+            line += f", throttled {status['throttled-seconds'] / 60:.0f} min"
+        if outcome.get('reported') is False:
+            line += ", NOT in T.A.R.A.L.L.O."
+        print(line)
+    passed = sum(1 for o in outcomes if o['success'])
+    print(f"{passed} passed, {len(outcomes) - passed} failed")
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Automatically drill every single connected hard drive.')
     parser.add_argument('-s', '--shutdown', action='store_true', help='Shutdown the machine when everything is done.')
@@ -188,7 +550,40 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--dry', action='store_true', help='Launch simulation.')
     parser.add_argument('--no-tarallo', action='store_false', help="Don't add disks to the T.A.R.A.L.L.O. database.", dest='can_connect')
     parser.add_argument('--usb', action='store_true', help='Allow cleaning of usb drives (DEBUG ONLY!!!)')
+    parser.add_argument('--max-temp', type=int, default=thermal.MAX_TEMPERATURE, dest='max_temperature',
+                        help='Pause wiping disks hotter than this (°C, default %(default)s).')
+    parser.add_argument('--metadata-first', action='store_true',
+                        help='Overwrite partition tables and superblocks before the full wipe.')
+    parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS,
+                        help='Disks parsed with smartctl at once (default %(default)s).')
+    parser.add_argument('--max-wipes', type=int, default=0,
+                        help='Disks wiped at once (default: all of them).')
+    parser.add_argument('--cache-ttl', type=int, default=smartctl_parser.CACHE_TTL,
+                        help="Seconds before a disk's full smartctl output is read again (default %(default)s, 0 to disable).")
+    parser.add_argument('--aggregator', metavar='URL',
+                        help='Push the state of this run to a turbofresa aggregate running at URL.')
+    parser.add_argument('--station', default=None,
+                        help='Name of this station for the aggregator (default: hostname).')
+    parser.add_argument('--bays', type=int, default=None,
+                        help='Disk bays of this station, to let the aggregator know how many are free.')
     parser.add_argument('--version', '-V', action='version', version='%(prog)s v.' + __version__)
+    commands = parser.add_subparsers(dest='command', metavar='command',
+                                     help='Optional command, wipe the connected disks if omitted.')
+    backfill_parser = commands.add_parser('backfill', help='Parse again the archived smartctl outputs and update '
+                                                           'T.A.R.A.L.L.O. with what changed.')
+    backfill_parser.add_argument('directory', help='Directory with the archived outputs (e.g. smartctl/).')
+    backfill_parser.add_argument('-n', '--dry-run', action='store_true', help='Only show what would be changed.')
+    backfill_parser.add_argument('-j', '--workers', type=int, default=None,
+                                 help='Parsing processes (default: number of cores).')
+    backfill_parser.add_argument('--batch-size', type=int, default=backfill.BATCH_SIZE,
+                                 help='Disks compared before pushing their changes (default %(default)s).')
+    status_parser = commands.add_parser('status', help='Show the state of the disks in the current (or last) run.')
+    status_parser.add_argument('--json', action='store_true', help='Print the raw status file.')
+    aggregate_parser = commands.add_parser('aggregate', help='Collect and show the state of the stations started '
+                                                             'with --aggregator.')
+    aggregate_parser.add_argument('--host', default='', help='Address to listen on (default: all).')
+    # aggregator.PORT, the module isn't imported unless used: http.server and urllib.request are slow to import
+    aggregate_parser.add_argument('--port', type=int, default=8470, help='Port to listen on (default %(default)s).')
     parser.set_defaults(shutdown=False)
     parser.set_defaults(quiet=False)
     parser.set_defaults(dry=False)
@@ -199,6 +594,31 @@ if __name__ == '__main__':
     simulate = args.dry
     can_connect = args.can_connect
 
+    if args.command == 'status':
+        state = run_status.read()
+        if state is None:
+            print("No run found in " + os.getcwd())
+            exit(1)
+        if args.json:
+            print(json.dumps(state, indent=2))
+        else:
+            print(run_status.format_status(state))
+        exit(0)
+
+    if args.command == 'aggregate':
+        import aggregator
+        aggregator.serve(args.host, args.port)
+        exit(0)
+
+    if args.command == 'backfill':
+        tarallo_instance = connect_tarallo()
+        if tarallo_instance is None:
+            exit(1)
+        backfill.main(args, tarallo_instance)
+        if not quiet:
+            print(tarallo_instance.stats_summary())
+        exit(0)
+
     print("The program will completely wipe any disk outside system ones connected to the current machine")
 
     # Checking disks to ignore
@@ -207,44 +627,30 @@ if __name__ == '__main__':
     ignored = ignore_sys_disks()
     ignored = ignored + ignore_user_disks()
 
-    # Disks parsing
+    # Disks detection, only with lsblk: smartctl runs later, one disk at a time
     if not quiet:
         print("\n\n===> Detecting connected hard drives.")
-    disks = smartctl_parser.parse_disks(interactive=not quiet, usbdebug=args.usb, ignore=ignored)
-    if len(disks) == 0:
+    devices = smartctl_parser.filter_devices(smartctl_parser.list_devices(), ignored, interactive=not quiet)
+    if len(devices) == 0:
         print("No valid device detected.")
         exit(0)
-    tasks = []
-    ask_confirm(disks)
+    results = Queue()
+    ask_confirm(devices)
+    current_run = run_status.RunStatus()
+    agent = None
+    if args.aggregator:
+        import aggregator
+        agent = aggregator.Agent(args.aggregator, current_run, station=args.station, bays=args.bays)
+        agent.start()
 
     # Tarallo connection
     if can_connect:
-        if not quiet:
-            print('\n\n===> Connecting to T.A.R.A.L.L.O. database')
-        load_dotenv()
-        tarallo_instance = TaralloInterface()
-        if not tarallo_instance.connect(os.getenv("TARALLO_URL"), os.getenv("TARALLO_TOKEN")):
+        tarallo_instance = connect_tarallo()
+        if tarallo_instance is None:
             print("Continuing without T.A.R.A.L.L.O. connection")
-            tarallo_instance = None
-
-    # Adding disks to clean in queue and adding them to Tarallo if not present
-    if not quiet and tarallo_instance is not None:
-        print('\n\n===> Adding disks to T.A.R.A.L.L.O.')
-
-    for d in disks:
-        disk = d['features']
-        disk['erased'] = None
-        disk['surface-scan'] = None
-
-        if tarallo_instance is not None:
-            if tarallo_instance.add_disk(disk) is False:
-                print("Something went wrong with Disk addition to database, skipping to the next one")
-                continue
-            d['code'] = tarallo_instance.get_instance().get_codes_by_feature('sn', disk['sn'])
-
-        tasks.append(Task(d))
 
     # Time to TURBOFRESA
+    # Each disk is parsed, added to Tarallo and cleaned as soon as it's ready
 
     if not quiet:
         print("\n\n===> Cleaning disks")
@@ -254,25 +660,35 @@ if __name__ == '__main__':
         if 'badblocks_error_logs' not in os.listdir(os.getcwd()):
             os.mkdir('badblocks_error_logs')
 
-    # Start all tasks
-    for t in tasks:
-        if not quiet:
-            print("Started cleaning /dev/" + t.disk['mount_point'])
-        if not simulate:
-            t.start()
+    pipeline = Pipeline(results, parse_workers=args.parse_workers, wipe_workers=args.max_wipes,
+                        usbdebug=args.usb, cache_ttl=args.cache_ttl, max_temperature=args.max_temperature,
+                        metadata_first=args.metadata_first)
+    pipeline.start(devices)
+    disks = pipeline.disks
 
     # Wait for threads completition
-    for t in tasks:
-        if not simulate:
+    if not simulate:
+        history = []
+        outcomes = collect_results(pipeline.tasks, results, pipeline.done, history)
+        for t in pipeline.tasks:
             t.join()
-        else:
-            if not quiet:
-                print("Ended cleaning /dev/" + t.disk['mount_point'])
+        fleet.write_shard(history)
+        if len(fleet.shards()) > fleet.COMPACT_AFTER:
+            fleet.compact()
+        if not quiet:
+            print_summary(outcomes)
+    else:
+        pipeline.done.wait()
 
     # TODO: evaluate if removing this piece
     if simulate and tarallo_instance is not None:
         for d in disks:
-            tarallo_instance.get_instance().remove_item(d['code'][0])
+            tarallo_instance.remove_item(d['code'][0])
+    if tarallo_instance is not None and not quiet:
+        print(tarallo_instance.stats_summary())
+    current_run.finish()
+    if agent is not None:
+        agent.stop()
 
     if args.shutdown is True:
         if not simulate: